@@ -4,7 +4,7 @@ from django.utils import html
 from django.core.urlresolvers import reverse
 from mailhole.models import (
     Mailbox, Peer, Message, SentMessage, FilterRule,
-    MonitorMessage,
+    MonitorMessage, ForwardQueueItem, BulkAction,
 )
 
 
@@ -60,8 +60,10 @@ class PeerAdmin(admin.ModelAdmin):
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('subject', 'created_time', 'get_status', 'from_', 'to_as_html')
     list_display_links = ('subject',)
+    list_select_related = ('status_by', 'filtered_by')
 
     list_filter = ('status_by',)
+    search_fields = ('header_from_address', 'header_subject')
 
     def get_status(self, o):
         by = o.status_by or o.filtered_by
@@ -74,6 +76,7 @@ class MessageAdmin(admin.ModelAdmin):
 @admin.register(SentMessage)
 class SentMessageAdmin(admin.ModelAdmin):
     list_display = ('subject', 'recipient', 'created_time', 'created_by')
+    list_select_related = ('message', 'created_by')
 
     list_filter = ('created_by',)
 
@@ -100,3 +103,17 @@ class FilterRuleAdmin(admin.ModelAdmin):
 @admin.register(MonitorMessage)
 class MonitorMessageAdmin(admin.ModelAdmin):
     list_display = ('created_time', 'user', 'inbox_size', 'age_days')
+
+
+@admin.register(ForwardQueueItem)
+class ForwardQueueItemAdmin(admin.ModelAdmin):
+    list_display = ('created_time', 'message', 'attempts',
+                    'next_attempt_time', 'last_error')
+    list_select_related = ('message',)
+
+
+@admin.register(BulkAction)
+class BulkActionAdmin(admin.ModelAdmin):
+    list_display = ('created_time', 'created_by', 'status', 'sender', 'peer',
+                    'action', 'done', 'total', 'finished_time')
+    list_select_related = ('created_by', 'peer')
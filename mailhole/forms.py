@@ -1,12 +1,14 @@
 import json
 import logging
 
+import django.core.mail
 from django import forms
 from django.conf import settings
+from django.db import transaction
 from django.contrib.auth import forms as auth_forms
 
 from mailhole.models import (
-    Peer, Message, SentMessage, FilterRule,
+    Peer, Message, SentMessage, FilterRule, BulkAction,
 )
 
 
@@ -41,8 +43,10 @@ def split_by_domain(rcpt_tos):
     return [by_domain[k] for k in sorted(by_domain)]
 
 
-class SubmitForm(forms.Form):
-    key = forms.CharField()
+class SubmitEnvelopeForm(forms.Form):
+    '''
+    A single message submitted by an already authenticated Peer.
+    '''
     mail_from = forms.CharField()
     rcpt_tos = forms.CharField()
     message_bytes = forms.FileField()
@@ -70,21 +74,17 @@ class SubmitForm(forms.Form):
     def clean_orig_rcpt_tos(self):
         return self._clean_rcpt_tos(self.cleaned_data['orig_rcpt_tos'])
 
-    def clean(self):
-        key = self.cleaned_data.pop('key')
-        self.cleaned_data['peer'] = Peer.validate(key)
-
-    def save(self):
-        self.cleaned_data['message_bytes'].open('rb')
-        message_bytes = self.cleaned_data['message_bytes'].read()
-        self.cleaned_data['orig_message_bytes'].open('rb')
-        orig_message_bytes = self.cleaned_data['orig_message_bytes'].read()
+    def save(self, peer):
+        # The uploaded files are passed on as they are, since Message.create
+        # reads them in chunks rather than loading them into memory.
+        message_bytes = self.cleaned_data['message_bytes']
+        orig_message_bytes = self.cleaned_data['orig_message_bytes']
         split_orig_rcpt_tos = split_by_domain(
             self.cleaned_data['orig_rcpt_tos'])
         messages = []
         for orig_rcpt_tos in split_orig_rcpt_tos:
             messages.append(Message.create(
-                peer=self.cleaned_data['peer'],
+                peer=peer,
                 mail_from=self.cleaned_data['mail_from'],
                 rcpt_tos=self.cleaned_data['rcpt_tos'],
                 message_bytes=message_bytes,
@@ -95,6 +95,58 @@ class SubmitForm(forms.Form):
         return messages
 
 
+class SubmitForm(SubmitEnvelopeForm):
+    key = forms.CharField()
+
+    def clean(self):
+        key = self.cleaned_data.pop('key')
+        self.cleaned_data['peer'] = Peer.validate(key)
+
+    def save(self):
+        return super().save(self.cleaned_data['peer'])
+
+
+class BatchSubmitForm(forms.Form):
+    '''
+    Many messages submitted in one request.
+
+    envelopes is a JSON list of objects with the keys mail_from, rcpt_tos,
+    orig_mail_from and orig_rcpt_tos (rcpt_tos and orig_rcpt_tos are lists).
+    The message data of the i'th envelope is in the files message_bytes_i
+    and orig_message_bytes_i.
+    '''
+    key = forms.CharField()
+    envelopes = forms.CharField()
+
+    def clean_envelopes(self):
+        try:
+            envelopes = json.loads(self.cleaned_data['envelopes'])
+        except ValueError:
+            raise forms.ValidationError('Invalid JSON')
+        if not isinstance(envelopes, list):
+            raise forms.ValidationError('JSON is not a list')
+        if not all(isinstance(e, dict) for e in envelopes):
+            raise forms.ValidationError('JSON is not a list of objects')
+        return envelopes
+
+    def clean(self):
+        key = self.cleaned_data.pop('key', None)
+        if key is not None:
+            self.cleaned_data['peer'] = Peer.validate(key)
+
+    def envelope_forms(self):
+        for i, envelope in enumerate(self.cleaned_data['envelopes']):
+            data = dict(envelope)
+            for k in ('rcpt_tos', 'orig_rcpt_tos'):
+                if k in data:
+                    data[k] = json.dumps(data[k])
+            files = {
+                k: self.files.get('%s_%s' % (k, i))
+                for k in ('message_bytes', 'orig_message_bytes')
+            }
+            yield SubmitEnvelopeForm(data=data, files=files)
+
+
 class MessageListForm(forms.Form):
     def __init__(self, **kwargs):
         self.messages = list(kwargs.pop('queryset'))
@@ -137,29 +189,96 @@ class MessageListForm(forms.Form):
                 )
 
     def save(self, user):
+        # All forwarded messages are sent in one SMTP session,
+        # which is only opened if something is forwarded.
+        connection = django.core.mail.get_connection()
+        try:
+            self._save(user, connection)
+        finally:
+            connection.close()
+
+    def _save(self, user, connection):
+        selected = {mode: [] for mode in ('spam', 'trash', 'forward',
+                                          'whitelist')}
         for message in self.messages:
-            spam_k = 'spam_%s' % message.pk
-            forward_k = 'forward_%s' % message.pk
-            whitelist_k = 'whitelist_%s' % message.pk
-            trash_k = 'trash_%s' % message.pk
-            if self.cleaned_data[spam_k]:
+            for mode, messages in selected.items():
+                if self.cleaned_data['%s_%s' % (mode, message.pk)]:
+                    messages.append(message)
+        with transaction.atomic():
+            for message in selected['spam']:
                 logger.info('user:%s (%s) message:%s marked spam',
                             user.pk, user.username, message.pk)
-                message.set_status(Message.SPAM, user=user)
-                message.save()
-            if self.cleaned_data[trash_k]:
+            Message.set_status_many(selected['spam'], Message.SPAM, user=user)
+            for message in selected['trash']:
                 logger.info('user:%s (%s) message:%s marked trash',
                             user.pk, user.username, message.pk)
-                message.set_status(Message.TRASH, user=user)
-                message.save()
-            if self.cleaned_data[forward_k] or self.cleaned_data[whitelist_k]:
+            Message.set_status_many(selected['trash'], Message.TRASH,
+                                    user=user)
+            if selected['whitelist']:
+                # FilterRule.whitelist_from_many logs the action
+                FilterRule.whitelist_from_many(selected['whitelist'], user)
+        forwarded = []
+        try:
+            for message in selected['forward'] + selected['whitelist']:
                 # SentMessage.create_and_send logs the action
-                SentMessage.create_and_send(message=message, user=user)
-                message.set_status(Message.TRASH, user=user)
-                message.save()
-            if self.cleaned_data[whitelist_k]:
-                # FilterRule.whitelist_from logs the action
-                FilterRule.whitelist_from(message, user)
+                SentMessage.create_and_send(message=message, user=user,
+                                            connection=connection)
+                forwarded.append(message)
+        finally:
+            # Even if sending fails, don't forward the sent messages again.
+            Message.set_status_many(forwarded, Message.TRASH, user=user)
+
+
+class BulkActionForm(forms.ModelForm):
+    class Meta:
+        model = BulkAction
+        fields = ('sender', 'peer', 'action')
+        labels = {
+            'sender': 'Afsender',
+            'peer': 'Server',
+            'action': 'Handling',
+        }
+
+    def __init__(self, **kwargs):
+        self.status = kwargs.pop('status')
+        self.mailboxes = kwargs.pop('mailboxes')
+        super().__init__(**kwargs)
+        # Only show the peers that have sent messages to the mailboxes.
+        peer_ids = Message.objects.filter(
+            mailbox__in=self.mailboxes).values('peer_id')
+        self.fields['peer'].queryset = Peer.objects.filter(pk__in=peer_ids)
+
+    def clean(self):
+        if self.cleaned_data.get('action') == self.status:
+            raise forms.ValidationError(
+                'Emailene er allerede i %s' %
+                Message.status_display(self.status))
+        if self.cleaned_data.get('sender'):
+            # BulkAction.get_queryset matches the sender on
+            # header_from_address, so messages where it has not been
+            # filled in yet would be skipped.
+            missing = Message.objects.filter(
+                status=self.status, mailbox__in=self.mailboxes,
+                header_from_address__isnull=True)
+            if missing.exists():
+                raise forms.ValidationError(
+                    'Afsenderen kendes ikke for alle emails endnu ' +
+                    '(se ./manage.py populate_header_fields)')
+
+    def save(self, user):
+        bulk_action = super().save(commit=False)
+        bulk_action.created_by = user
+        bulk_action.status = self.status
+        bulk_action.save()
+        bulk_action.mailboxes.set(self.mailboxes)
+        bulk_action.total = bulk_action.get_queryset().count()
+        bulk_action.save()
+        logger.info('user:%s (%s) bulk:%s created: %s messages in %s ' +
+                    'from %r peer %s marked %s',
+                    user.pk, user.username, bulk_action.pk,
+                    bulk_action.total, self.status, bulk_action.sender,
+                    bulk_action.peer, bulk_action.action)
+        return bulk_action
 
 
 class MessageDetailForm(forms.Form):
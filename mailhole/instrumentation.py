@@ -0,0 +1,240 @@
+import time
+import logging
+import threading
+import contextlib
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends.utils import CursorWrapper, CursorDebugWrapper
+
+import mailhole.metrics
+
+
+logger = logging.getLogger('mailhole')
+
+# The parts of a request that are timed besides the database, see timer().
+STORAGE = 'storage'
+MIME = 'mime'
+SMTP = 'smtp'
+TIMERS = (STORAGE, MIME, SMTP)
+# SQL queries, timed by TimedCursorWrapper.
+DB = 'db'
+
+# Upper bounds in milliseconds of the buckets of the request time histogram.
+BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, None)
+
+_local = threading.local()
+
+
+class RequestTimers:
+    '''
+    The number of SQL queries and the time spent in them and in each of
+    TIMERS during one request.
+    Nested timers are not counted twice: the time spent in an inner timer
+    is only counted towards the inner timer.
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = dict.fromkeys(TIMERS + (DB,), 0.0)
+        # [name, start] of the running timers, innermost last
+        self.running = []
+
+    def start(self, name):
+        now = time.perf_counter()
+        if self.running:
+            outer = self.running[-1]
+            self.seconds[outer[0]] += now - outer[1]
+        self.running.append([name, now])
+
+    def stop(self):
+        now = time.perf_counter()
+        name, start = self.running.pop()
+        self.seconds[name] += now - start
+        if self.running:
+            self.running[-1][1] = now
+
+
+@contextlib.contextmanager
+def timer(name):
+    '''
+    Count the time spent in the with-block towards name (one of TIMERS)
+    in the current request. Does nothing outside a request.
+    '''
+    timers = getattr(_local, 'timers', None)
+    if timers is None:
+        yield
+        return
+    timers.start(name)
+    try:
+        yield
+    finally:
+        timers.stop()
+
+
+class QueryTimerMixin:
+    def execute(self, sql, params=None):
+        with query_timer():
+            return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        with query_timer():
+            return super().executemany(sql, param_list)
+
+
+class TimedCursorWrapper(QueryTimerMixin, CursorWrapper):
+    pass
+
+
+class TimedCursorDebugWrapper(QueryTimerMixin, CursorDebugWrapper):
+    pass
+
+
+@contextlib.contextmanager
+def query_timer():
+    timers = getattr(_local, 'timers', None)
+    if timers is not None:
+        timers.queries += 1
+    with timer(DB):
+        yield
+
+
+def _timed_execute(execute, sql, params, many, context):
+    with query_timer():
+        return execute(sql, params, many, context)
+
+
+def _time_queries(db, stack):
+    '''
+    Make db (the database connection of this thread) time its queries.
+    Django 2.0 has db.execute_wrapper() for this, but in Django 1.11 we
+    choose the class that wraps its cursors instead.
+    '''
+    if hasattr(db, 'execute_wrapper'):
+        stack.enter_context(db.execute_wrapper(_timed_execute))
+    elif not getattr(db, 'mailhole_time_queries', False):
+        db.make_cursor = lambda cursor: TimedCursorWrapper(cursor, db)
+        db.make_debug_cursor = (
+            lambda cursor: TimedCursorDebugWrapper(cursor, db))
+        db.mailhole_time_queries = True
+
+
+class ViewStats:
+    def __init__(self, view):
+        self.view = view
+        self.requests = 0
+        self.errors = 0
+        self.max_ms = 0
+        self.buckets = [0] * len(BUCKETS)
+        self.totals = dict.fromkeys(('ms', 'queries', 'db_ms') +
+                                    tuple(t + '_ms' for t in TIMERS), 0)
+
+    def add(self, record):
+        self.requests += 1
+        if record['status'] >= 500:
+            self.errors += 1
+        self.max_ms = max(self.max_ms, record['ms'])
+        for i, bound in enumerate(BUCKETS):
+            if bound is None or record['ms'] <= bound:
+                self.buckets[i] += 1
+                break
+        for k in self.totals:
+            self.totals[k] += record[k]
+
+    def percentile(self, p):
+        '''
+        Upper bound of the bucket containing the p'th percentile.
+        '''
+        n = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            n += count
+            if n >= p / 100 * self.requests:
+                return bound if bound is not None else self.max_ms
+        return self.max_ms
+
+    def means(self):
+        return {k: v / self.requests for k, v in self.totals.items()}
+
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def record_request(record):
+    with _stats_lock:
+        try:
+            stats = _stats[record['view']]
+        except KeyError:
+            stats = _stats[record['view']] = ViewStats(record['view'])
+        stats.add(record)
+
+
+def view_stats():
+    '''
+    The ViewStats of this process since it was started (or reset_stats()),
+    slowest views first.
+    '''
+    with _stats_lock:
+        stats = [
+            dict(view=s.view, requests=s.requests, errors=s.errors,
+                 max_ms=s.max_ms, buckets=list(s.buckets),
+                 p50_ms=s.percentile(50), p95_ms=s.percentile(95),
+                 means=s.means())
+            for s in _stats.values()
+        ]
+    stats.sort(key=lambda s: s['means']['ms'] * s['requests'], reverse=True)
+    return stats
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+class InstrumentationMiddleware:
+    '''
+    Measure the number of SQL queries, the database time and the time spent
+    in each of TIMERS for every request. The numbers are aggregated per view
+    in this process for the RequestStats view, and if
+    settings.LOG_REQUEST_STATS is set, each request is logged to the
+    mailhole logger. Also flushes mailhole.metrics.
+
+    Should be the first middleware, so it sees the queries made by the
+    other middleware (e.g. loading the session and the user).
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timers = _local.timers = RequestTimers()
+        t = time.perf_counter()
+        status = 500
+        try:
+            with contextlib.ExitStack() as stack:
+                _time_queries(connections[DEFAULT_DB_ALIAS], stack)
+                response = self.get_response(request)
+            status = response.status_code
+            return response
+        finally:
+            ms = 1000 * (time.perf_counter() - t)
+            del _local.timers
+            resolver_match = getattr(request, 'resolver_match', None)
+            record = dict(
+                view=resolver_match.view_name if resolver_match else '-',
+                status=status,
+                ms=ms,
+                queries=timers.queries,
+                db_ms=1000 * timers.seconds[DB],
+            )
+            for name in TIMERS:
+                record[name + '_ms'] = 1000 * timers.seconds[name]
+            record_request(record)
+            mailhole.metrics.flush()
+            if settings.LOG_REQUEST_STATS:
+                logger.info('request view:%(view)s status:%(status)s ' +
+                            'ms:%(ms).1f queries:%(queries)s ' +
+                            'db_ms:%(db_ms).1f ' +
+                            'storage_ms:%(storage_ms).1f ' +
+                            'mime_ms:%(mime_ms).1f smtp_ms:%(smtp_ms).1f',
+                            record)
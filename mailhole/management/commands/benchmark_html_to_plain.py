@@ -0,0 +1,74 @@
+import os
+import time
+import email
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mailhole.utils import html_to_plain
+
+
+class Command(BaseCommand):
+    help = ('Time html_to_plain on a corpus of HTML bodies, given as ' +
+            '.html files or .eml/.mail messages or directories of these.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='+')
+        parser.add_argument('--limit', type=int,
+                            default=settings.HTML_TO_PLAIN_LIMIT,
+                            help='Size cap (default HTML_TO_PLAIN_LIMIT, ' +
+                                 '0 to convert everything)')
+        parser.add_argument('--slowest', type=int, default=10)
+
+    def handle(self, *args, **options):
+        limit = options['limit'] or None
+        results = []
+        for filename in self.find_files(options['path']):
+            body = self.read_html(filename)
+            if body is None:
+                continue
+            t = time.perf_counter()
+            html_to_plain(body, limit)
+            results.append((time.perf_counter() - t, len(body), filename))
+        if not results:
+            raise CommandError('No HTML bodies found')
+        results.sort()
+        durations = [r[0] for r in results]
+        total = sum(durations)
+        self.stdout.write('%d bodies, %.1f MB, limit %s' %
+                          (len(results), sum(r[1] for r in results) / 2**20,
+                           limit))
+        self.stdout.write('total %.2f s, median %.1f ms, max %.1f ms' %
+                          (total, 1000 * durations[len(durations) // 2],
+                           1000 * durations[-1]))
+        self.stdout.write('Slowest:')
+        for duration, length, filename in results[::-1][:options['slowest']]:
+            self.stdout.write('%8.1f ms %9d chars  %s' %
+                              (1000 * duration, length, filename))
+
+    def find_files(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        yield os.path.join(dirpath, filename)
+            else:
+                yield path
+
+    def read_html(self, filename):
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in ('.html', '.htm'):
+            with open(filename, 'rb') as fp:
+                return fp.read().decode('utf8', errors='replace')
+        if ext in ('.eml', '.mail'):
+            with open(filename, 'rb') as fp:
+                message = email.message_from_binary_file(fp)
+            for part in message.walk():
+                if part.get_content_type() == 'text/html':
+                    charset = part.get_content_charset('utf8')
+                    payload = part.get_payload(decode=True)
+                    try:
+                        return payload.decode(charset, errors='replace')
+                    except LookupError:
+                        return payload.decode('utf8', errors='replace')
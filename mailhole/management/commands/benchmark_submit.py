@@ -0,0 +1,271 @@
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import datetime
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import django
+from django.core import mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import (
+    CaptureQueriesContext, override_settings,
+    setup_test_environment, teardown_test_environment,
+)
+
+from mailhole.models import Mailbox, Peer, FilterRule
+from mailhole.utils import decode_any_header
+
+
+CORPORA = ('plain', 'multipart', 'newsletter', 'multidomain', 'rules',
+           'forward')
+
+WORDS = ('generalforsamling kasserer regnskab budget referat bestyrelse ' +
+         'indkaldelse dagsorden kontingent arrangement tilmelding frist ' +
+         'lokale jubilæum revy sangbog koncert the of and meeting').split()
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(sorted_values, p):
+    i = min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))
+    return sorted_values[i]
+
+
+class Command(BaseCommand):
+    help = ('Benchmark /api/submit/ (SubmitForm.save, Message.create and ' +
+            'filter_incoming) on synthetic corpora. Runs against a test ' +
+            'database and a temporary MEDIA_ROOT with the locmem email ' +
+            'backend, so it is safe to run on a production checkout.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', action='append', choices=CORPORA,
+                            help='Corpus to run (default: all)')
+        parser.add_argument('-n', '--count', type=int, default=200,
+                            help='Submissions per corpus')
+        parser.add_argument('--warmup', type=int, default=5,
+                            help='Untimed submissions before each corpus')
+        parser.add_argument('--rules', type=int, default=500,
+                            help='Number of FilterRules in the rules corpus')
+        parser.add_argument('--domains', type=int, default=5,
+                            help='Recipient domains in the multidomain corpus')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Reuse the test database')
+        parser.add_argument('--json', action='store_true',
+                            help='Write the results as JSON to stdout')
+
+    def handle(self, *args, **options):
+        if options['count'] < 1:
+            raise CommandError('--count must be positive')
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.serial = 0
+        corpora = options['corpus'] or CORPORA
+        # Sets the locmem email backend and allows the test client's host.
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False,
+                                keepdb=options['keepdb'])
+        old_config = runner.setup_databases()
+        media_root = tempfile.mkdtemp(prefix='mailhole-benchmark-')
+        try:
+            with override_settings(MEDIA_ROOT=media_root,
+                                   NO_OUTGOING_EMAIL=False,
+                                   FORWARD_QUEUE=False):
+                self.peer = Peer.objects.create(
+                    key='benchmark-%s' % time.time(), slug='benchmark')
+                self.client = Client()
+                results = [self.run_corpus(name) for name in corpora]
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        report = dict(
+            time=datetime.datetime.now().isoformat(),
+            python=platform.python_version(),
+            django=django.get_version(),
+            database=connection.vendor,
+            count=options['count'],
+            seed=options['seed'],
+            peak_rss_kb=peak_rss_kb(),
+            corpora=results,
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_table(report)
+
+    def run_corpus(self, name):
+        setup = getattr(self, 'setup_%s' % name, None)
+        if setup is not None:
+            setup()
+        make = getattr(self, 'make_%s' % name)
+        for i in range(self.options['warmup']):
+            self.submit(*make())
+        decode_any_header.cache_clear()
+        mail.outbox = []
+        durations = []
+        messages = queries = size = 0
+        for i in range(self.options['count']):
+            content, rcpt_tos = make()
+            size += len(content)
+            with CaptureQueriesContext(connection) as ctx:
+                t = time.perf_counter()
+                response = self.submit(content, rcpt_tos)
+                durations.append(time.perf_counter() - t)
+            if response.status_code != 200:
+                raise CommandError('%s: %s %s' % (name, response.status_code,
+                                                  response.content[:500]))
+            # SubmitForm.save stores a Message per recipient domain.
+            messages += len(set(r.split('@')[1] for r in rcpt_tos))
+            queries += len(ctx.captured_queries)
+        elapsed = sum(durations)
+        teardown = getattr(self, 'teardown_%s' % name, None)
+        if teardown is not None:
+            teardown()
+        durations.sort()
+        cache = decode_any_header.cache_info()
+        return dict(
+            corpus=name,
+            submissions=len(durations),
+            messages=messages,
+            megabytes=round(size / 2**20, 3),
+            seconds=round(elapsed, 3),
+            submissions_per_sec=round(len(durations) / elapsed, 1),
+            messages_per_sec=round(messages / elapsed, 1),
+            p50_ms=round(1000 * percentile(durations, 50), 2),
+            p99_ms=round(1000 * percentile(durations, 99), 2),
+            max_ms=round(1000 * durations[-1], 2),
+            queries_per_message=round(queries / messages, 1),
+            emails_sent=len(mail.outbox),
+            header_cache_hit_rate=round(
+                cache.hits / max(1, cache.hits + cache.misses), 3),
+            peak_rss_kb=peak_rss_kb(),
+        )
+
+    def submit(self, content, rcpt_tos):
+        mail_from = 'bounce-%s@sender.example.com' % self.serial
+        data = dict(
+            key=self.peer.key,
+            mail_from=mail_from,
+            rcpt_tos=json.dumps(rcpt_tos),
+            orig_mail_from=mail_from,
+            orig_rcpt_tos=json.dumps(rcpt_tos),
+            message_bytes=SimpleUploadedFile('message_bytes', content),
+            orig_message_bytes=SimpleUploadedFile('orig_message_bytes',
+                                                  content),
+        )
+        return self.client.post(reverse('submit'), data)
+
+    def write_table(self, report):
+        self.stdout.write('Python %(python)s, Django %(django)s, %(database)s'
+                          % report)
+        self.stdout.write('%-12s %8s %8s %9s %9s %9s %9s %8s %10s' % (
+            'corpus', 'msgs', 'MB', 'msgs/s', 'p50 ms', 'p99 ms', 'max ms',
+            'queries', 'rss MB'))
+        for r in report['corpora']:
+            self.stdout.write(
+                '%-12s %8d %8.1f %9.1f %9.1f %9.1f %9.1f %8.1f %10.1f' % (
+                    r['corpus'], r['messages'], r['megabytes'],
+                    r['messages_per_sec'], r['p50_ms'], r['p99_ms'],
+                    r['max_ms'], r['queries_per_message'],
+                    r['peak_rss_kb'] / 1024))
+
+    # Corpora. Each make_* returns (message bytes, recipients).
+
+    def words(self, n):
+        return ' '.join(self.rng.choice(WORDS) for i in range(n))
+
+    def headers(self, message, to):
+        self.serial += 1
+        message['From'] = 'Afsender %s <sender%s@sender.example.com>' % (
+            self.serial % 50, self.serial % 50)
+        message['To'] = ', '.join(to)
+        message['Subject'] = '%s %s' % (self.words(6).capitalize(),
+                                       self.serial)
+        message['Message-ID'] = '<benchmark-%s-%s@sender.example.com>' % (
+            self.options['seed'], self.serial)
+        message['Date'] = 'Mon, 02 Jan 2017 12:00:00 +0100'
+        crlf = message.policy.clone(linesep='\r\n')
+        return message.as_bytes(policy=crlf)
+
+    def plain(self, to, paragraphs=5):
+        body = '\n\n'.join(self.words(60) for i in range(paragraphs))
+        return self.headers(MIMEText(body, 'plain', 'utf-8'), to), to
+
+    def make_plain(self):
+        return self.plain(['bestyrelsen@plain.example.org'])
+
+    def make_multipart(self):
+        message = MIMEMultipart()
+        message.attach(MIMEText(self.words(200), 'plain', 'utf-8'))
+        message.attach(MIMEApplication(
+            self.rng.getrandbits(8 * 2**19).to_bytes(2**19, 'little'),
+            'pdf', Name='referat.pdf'))
+        to = ['kasserer@multipart.example.org']
+        return self.headers(message, to), to
+
+    def make_newsletter(self):
+        rows = ''.join(
+            '<tr><td class="x" style="padding:8px">' +
+            '<a href="https://news.example.com/%s">%s</a></td>' % (i, i) +
+            '<td><p>%s &amp; <b>%s</b></p></td></tr>' % (self.words(40),
+                                                         self.words(5))
+            for i in range(400))
+        html = ('<html><head><style>td {font-family: sans-serif}</style>' +
+                '</head><body><table>%s</table></body></html>' % rows)
+        to = ['nyhedsbrev@newsletter.example.org']
+        return self.headers(MIMEText(html, 'html', 'utf-8'), to), to
+
+    def make_multidomain(self):
+        to = ['info@d%s.multidomain.example.org' % i
+              for i in range(self.options['domains'])]
+        return self.plain(to)
+
+    def setup_rules(self):
+        # Patterns that don't match the corpus, so every message is tested
+        # against every rule except the last, which marks it as spam.
+        kinds = [FilterRule.SUBJECT_MATCH, FilterRule.SENDER_MATCH,
+                 FilterRule.HEADER_MATCH]
+        rules = []
+        for i in range(self.options['rules']):
+            kind = kinds[i % len(kinds)]
+            if kind == FilterRule.HEADER_MATCH:
+                pattern = r'^X-Mailer: .*mailer%s\b' % i
+            else:
+                pattern = r'\bnomatch%s\b' % i
+            rules.append(FilterRule(order=i, peer=self.peer, kind=kind,
+                                    pattern=pattern, examples='',
+                                    action=FilterRule.MARK_SPAM))
+        rules.append(FilterRule(order=len(rules), kind=FilterRule.SENDER_MATCH,
+                                pattern=r'@sender\.example\.com',
+                                examples='', action=FilterRule.MARK_SPAM))
+        FilterRule.objects.bulk_create(rules)
+
+    def teardown_rules(self):
+        FilterRule.objects.all().delete()
+
+    def make_rules(self):
+        return self.plain(['spam@rules.example.org'])
+
+    def setup_forward(self):
+        Mailbox.objects.create(name='forward.example.org',
+                               default_action=Mailbox.FORWARD)
+
+    def make_forward(self):
+        return self.plain(['alle@forward.example.org'])
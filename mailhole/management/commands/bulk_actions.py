@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mailhole.models import BulkAction
+
+
+class Command(BaseCommand):
+    help = ('Process the BulkActions created from the message lists ' +
+            '("Markér alle emails") in batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when all bulk actions are finished ' +
+                                 '(e.g. when running from cron)')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to sleep when there is nothing ' +
+                                 'to do')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        while True:
+            n = self.process_pending(options['batch_size'])
+            if n == 0:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+
+    def process_pending(self, batch_size):
+        '''
+        Process a batch of each unfinished BulkAction, so that a huge one
+        doesn't hold up the others. Returns the number of messages.
+        '''
+        pending = BulkAction.objects.filter(finished_time__isnull=True)
+        n = 0
+        for bulk_action in pending.order_by('pk'):
+            n += bulk_action.process_batch(batch_size)
+        return n
@@ -0,0 +1,81 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from mailhole.models import Mailbox, Message
+
+
+class Command(BaseCommand):
+    help = ('Run EXPLAIN on the hot Message queries and fail if any of ' +
+            'them does a full table scan. Run it against a database ' +
+            'with realistic data, since MySQL prefers full scans of ' +
+            'small tables.')
+
+    def hot_queries(self):
+        mailbox_ids = list(Mailbox.objects.values_list('pk', flat=True))
+        mailbox_id = mailbox_ids[0] if mailbox_ids else 1
+        by_date = '-created_time'
+        # MailboxMessageList
+        yield 'mailbox_message_list', Message.objects.filter(
+            mailbox_id=mailbox_id, status=Message.INBOX,
+        ).order_by(by_date)[:100]
+        # MessageList
+        yield 'message_list', Message.objects.filter(
+            mailbox__in=mailbox_ids or [mailbox_id], status=Message.TRASH,
+        ).order_by(by_date)[:100]
+        # Mailbox.count_folders
+        yield 'count_folders', Message.objects.filter(
+            mailbox__in=mailbox_ids or [mailbox_id],
+        ).values('mailbox_id', 'status').order_by()
+        # Message.exists_earlier_identical_forwarded_message
+        message = Message(message_id='<check_query_plans@localhost>',
+                          created_time=timezone.now(), rcpt_tos='')
+        yield ('earlier_identical_forwarded_messages',
+               message.earlier_identical_forwarded_messages())
+        # monitor.main
+        yield 'monitor', Message.objects.filter(status=Message.INBOX)
+
+    def explain(self, qs):
+        sql, params = qs.query.sql_with_params()
+        vendor = connection.vendor
+        with connection.cursor() as cursor:
+            if vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = [row[-1] for row in cursor.fetchall()]
+                full_scans = [
+                    line for line in plan
+                    if re.match(r'SCAN (TABLE )?mailhole_message\b', line)
+                    and 'USING' not in line]
+            elif vendor == 'mysql':
+                cursor.execute('EXPLAIN ' + sql, params)
+                columns = [c[0] for c in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                plan = ['table=%(table)s type=%(type)s key=%(key)s' % row
+                        for row in rows]
+                full_scans = ['table=%(table)s type=ALL' % row
+                              for row in rows
+                              if row['table'] == 'mailhole_message'
+                              and row['type'] == 'ALL']
+            elif vendor == 'postgresql':
+                cursor.execute('EXPLAIN ' + sql, params)
+                plan = [row[0] for row in cursor.fetchall()]
+                full_scans = [line for line in plan
+                              if 'Seq Scan on mailhole_message ' in line]
+            else:
+                raise CommandError('Unsupported database %r' % vendor)
+        return plan, full_scans
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, qs in self.hot_queries():
+            plan, full_scans = self.explain(qs)
+            self.stdout.write('%s:' % name)
+            for line in plan:
+                self.stdout.write('    %s' % line)
+            if full_scans:
+                failed.append(name)
+        if failed:
+            raise CommandError('Full table scan in: %s' % ', '.join(failed))
+        self.stdout.write('No full table scans.')
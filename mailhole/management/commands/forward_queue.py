@@ -0,0 +1,148 @@
+import time
+import datetime
+import logging
+
+import django.core.mail
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from mailhole.models import ForwardQueueItem, SentMessage
+import mailhole.metrics
+
+
+logger = logging.getLogger('mailhole')
+
+# Retry after 1 minute, 2 minutes, 4 minutes, ..., at most every 6 hours.
+BACKOFF_BASE = datetime.timedelta(minutes=1)
+BACKOFF_MAX = datetime.timedelta(hours=6)
+# An item is claimed by moving its next_attempt_time this far into the
+# future, so if a worker dies while sending, another worker retries it.
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+
+class Command(BaseCommand):
+    help = ('Forward the messages queued by Message.forward_automatically ' +
+            'when settings.FORWARD_QUEUE is set.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when no more items are due ' +
+                                 '(e.g. when running from cron)')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--max-attempts', type=int, default=20,
+                            help='Give up on an item after this many ' +
+                                 'failed attempts')
+        parser.add_argument('--stats', action='store_true',
+                            help='Print queue depth and age and the items ' +
+                                 'that were given up on, and exit')
+        parser.add_argument('--purge-failed', action='store_true',
+                            help='Delete the items that were given up on ' +
+                                 'and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.print_stats(options['max_attempts'])
+            return
+        if options['purge_failed']:
+            self.purge_failed(options['max_attempts'])
+            return
+        if settings.NO_OUTGOING_EMAIL:
+            raise CommandError("NO_OUTGOING_EMAIL is set - don't send anything")
+        while True:
+            n = self.process_due(options['batch_size'],
+                                 options['max_attempts'])
+            if n < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+
+    def process_due(self, batch_size, max_attempts):
+        items = ForwardQueueItem.objects.filter(
+            next_attempt_time__lte=timezone.now(),
+            attempts__lt=max_attempts,
+        )
+        items = items.select_related('message', 'message__mailbox',
+                                     'message__peer')
+        items = list(items.order_by('next_attempt_time')[:batch_size])
+        # Send the whole batch in one SMTP session.
+        connection = django.core.mail.get_connection()
+        try:
+            for item in items:
+                self.process(item, connection)
+        finally:
+            connection.close()
+            mailhole.metrics.flush()
+        return len(items)
+
+    def claim(self, item):
+        '''
+        Take item from the queue for CLAIM_TIMEOUT. Returns False if another
+        worker has claimed or processed it since it was selected.
+        '''
+        claimed_until = timezone.now() + CLAIM_TIMEOUT
+        n = ForwardQueueItem.objects.filter(
+            pk=item.pk, next_attempt_time=item.next_attempt_time,
+        ).update(next_attempt_time=claimed_until)
+        item.next_attempt_time = claimed_until
+        return n == 1
+
+    def process(self, item, connection):
+        if not self.claim(item):
+            logger.debug('forwardqueueitem:%s claimed by another worker',
+                         item.pk)
+            return
+        message = item.message
+        try:
+            # SentMessage.create_and_send logs the action
+            SentMessage.create_and_send(
+                message, user=None, recipients=item.remaining_recipients(),
+                connection=connection)
+        except Exception as exn:
+            # The SMTP session may be broken; reconnect for the next item.
+            connection.close()
+            item.attempts += 1
+            delay = min(BACKOFF_BASE * 2 ** (item.attempts - 1), BACKOFF_MAX)
+            item.next_attempt_time = timezone.now() + delay
+            item.last_error = '%s: %s' % (type(exn).__name__, exn)
+            item.save()
+            logger.exception('forwardqueueitem:%s message:%s attempt %s ' +
+                             'failed, retry at %s',
+                             item.pk, message.pk, item.attempts,
+                             item.next_attempt_time)
+            return
+        latency = timezone.now() - item.created_time
+        logger.info('forwardqueueitem:%s message:%s forwarded %.1f s ' +
+                    'after submit (attempt %s)',
+                    item.pk, message.pk, latency.total_seconds(),
+                    item.attempts + 1)
+        item.delete()
+
+    def print_stats(self, max_attempts):
+        now = timezone.now()
+        qs = ForwardQueueItem.objects.all()
+        oldest = qs.aggregate(t=Min('created_time'))['t']
+        self.stdout.write('queued=%s due=%s failed=%s oldest_age_seconds=%s' % (
+            qs.filter(attempts__lt=max_attempts).count(),
+            qs.filter(attempts__lt=max_attempts,
+                      next_attempt_time__lte=now).count(),
+            qs.filter(attempts__gte=max_attempts).count(),
+            0 if oldest is None else int((now - oldest).total_seconds()),
+        ))
+        failed = qs.filter(attempts__gte=max_attempts).order_by('pk')
+        for item in failed:
+            self.stdout.write('failed forwardqueueitem:%s message:%s ' % (
+                item.pk, item.message_id) + 'queued:%s attempts:%s %s' % (
+                item.created_time.isoformat(), item.attempts,
+                item.last_error.splitlines()[0] if item.last_error else ''))
+
+    def purge_failed(self, max_attempts):
+        qs = ForwardQueueItem.objects.filter(attempts__gte=max_attempts)
+        for item in qs.order_by('pk'):
+            logger.info('forwardqueueitem:%s message:%s deleted after %s ' +
+                        'failed attempts', item.pk, item.message_id,
+                        item.attempts)
+            item.delete()
@@ -0,0 +1,172 @@
+import os
+import gzip
+import json
+import datetime
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from mailhole.models import Mailbox, Message
+from mailhole.storage import (
+    PackedFileSystemStorage, PACK_DIR, packed_name, split_packed_name,
+)
+
+
+logger = logging.getLogger('mailhole')
+
+FILE_FIELDS = ('message_file', 'orig_message_file')
+
+
+class Pack:
+    '''
+    A pack being written. It is written to "<name>.tmp" and renamed
+    when closed, together with "<name>.idx", a JSON line per file with its
+    packed name, original name and size.
+    '''
+
+    def __init__(self, storage, month):
+        self.storage = storage
+        n = 1
+        while True:
+            self.name = '%s/%s/%04d.pack' % (PACK_DIR, month, n)
+            if not (storage.exists(self.name) or
+                    storage.exists(self.name + '.tmp')):
+                break
+            n += 1
+        self.path = storage.path(self.name)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fp = open(self.path + '.tmp', 'xb')
+        self.index = []
+        # (pk, field, old name, new name) to save when the pack is closed
+        self.updates = []
+        # Files referenced by several messages are only packed once.
+        self.packed = {}
+
+    def add(self, name):
+        try:
+            return self.packed[name]
+        except KeyError:
+            pass
+        with self.storage.open(name, 'rb') as fp:
+            data = fp.read()
+        compressed = gzip.compress(data, compresslevel=6)
+        offset = self.fp.tell()
+        self.fp.write(compressed)
+        new_name = packed_name(self.name, offset, len(compressed))
+        self.index.append(dict(name=new_name, orig_name=name, size=len(data)))
+        self.packed[name] = new_name
+        return new_name
+
+    def size(self):
+        return self.fp.tell()
+
+    def discard(self):
+        self.fp.close()
+        os.remove(self.path + '.tmp')
+
+    def close(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        with open(self.path + '.idx', 'w') as fp:
+            for entry in self.index:
+                fp.write(json.dumps(entry) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(self.path + '.tmp', self.path)
+
+
+class Command(BaseCommand):
+    help = ('Move the files of messages older than --days into ' +
+            'compressed packs, one or more per month. Requires ' +
+            'DEFAULT_FILE_STORAGE = ' +
+            '"mailhole.storage.PackedFileSystemStorage".')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pack-size', type=int, default=256,
+                            help='Start a new pack after this many MB')
+
+    def handle(self, *args, **options):
+        self.storage = Message._meta.get_field('message_file').storage
+        if not isinstance(self.storage, PackedFileSystemStorage):
+            raise CommandError('The message storage is not a ' +
+                               'PackedFileSystemStorage')
+        pack_size = options['pack_size'] * 2**20
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        qs = Message.objects.filter(created_time__lt=cutoff)
+        # The files of messages in mailboxes with data retention "Slet" are
+        # deleted soon (by mailhole.policy.data_retention_after_send or
+        # ./manage.py purge_messages), so they are not worth packing.
+        qs = qs.exclude(mailbox__data_retention=Mailbox.DELETE)
+        unpacked = Q()
+        for field in FILE_FIELDS:
+            unpacked |= (Q(**{field + '__gt': ''}) &
+                         ~Q(**{field + '__startswith': PACK_DIR + '/'}))
+        qs = qs.filter(unpacked).order_by('pk')
+        qs = qs.values_list('pk', 'created_time', *FILE_FIELDS)
+        total = qs.count()
+        self.messages = self.files = 0
+        packs = {}
+        done = 0
+        last_pk = 0
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            done += len(batch)
+            for pk, created_time, *names in batch:
+                month = timezone.localtime(created_time).strftime('%Y-%m')
+                if month not in packs:
+                    packs[month] = Pack(self.storage, month)
+                pack = packs[month]
+                for field, name in zip(FILE_FIELDS, names):
+                    if not name or split_packed_name(name) is not None:
+                        continue
+                    try:
+                        new_name = pack.add(name)
+                    except OSError as exn:
+                        logger.warning('pack_messages: message:%s %s: %s',
+                                       pk, field, exn)
+                        continue
+                    pack.updates.append((pk, field, name, new_name))
+                if pack.size() >= pack_size:
+                    self.finish(packs.pop(month))
+            self.stdout.write('\r[%6d/%d]' % (done, total), ending='')
+            self.stdout.flush()
+        for pack in packs.values():
+            self.finish(pack)
+        self.stdout.write('')
+        self.stdout.write('Packed %d files of %d messages' %
+                          (self.files, self.messages))
+
+    def finish(self, pack):
+        '''
+        Close pack and then point the messages at it, so an interrupted run
+        at most leaves a pack that no message refers to, which is deleted
+        by ./manage.py purge_messages --orphans.
+        '''
+        if not pack.index:
+            pack.discard()
+            return
+        size = pack.size()
+        pack.close()
+        with transaction.atomic():
+            for pk, field, name, new_name in pack.updates:
+                # Don't undo a concurrent change, e.g. by
+                # mailhole.policy.data_retention_after_send.
+                Message.objects.filter(pk=pk, **{field: name}).update(
+                    **{field: new_name})
+        names = set(name for pk, field, name, new_name in pack.updates)
+        touched_before = timezone.now() - Message.ORPHAN_MIN_AGE
+        for name in Message.unreferenced_files(names):
+            Message.delete_unreferenced_file(name, touched_before)
+        self.messages += len(set(u[0] for u in pack.updates))
+        self.files += len(pack.index)
+        logger.info('pack_messages: %s: %s files, %s bytes',
+                    pack.name, len(pack.index), size)
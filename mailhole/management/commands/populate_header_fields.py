@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from mailhole.models import Message
+
+
+class Command(BaseCommand):
+    help = ('Populate the decoded header_* fields of messages received ' +
+            'before they were introduced. Can be interrupted and resumed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        qs = Message.objects.filter(Q(header_subject__isnull=True) |
+                                    Q(header_date__isnull=True))
+        qs = qs.only('pk', 'headers').order_by('pk')
+        total = qs.count()
+        done = 0
+        last_pk = 0
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            for message in batch:
+                if message.headers == "":
+                    # Scrubbed by mailhole.policy.data_retention_after_send
+                    message.scrub_header_fields()
+                else:
+                    message.extract_header_fields()
+                message.save(update_fields=Message.HEADER_FIELDS)
+            done += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write('\r[%6d/%d]' % (done, total), ending='')
+            self.stdout.flush()
+        self.stdout.write('')
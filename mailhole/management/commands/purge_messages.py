@@ -0,0 +1,189 @@
+import datetime
+import logging
+import posixpath
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from mailhole.models import Mailbox, Message
+from mailhole.storage import PACK_DIR, PACK_SEP
+
+
+logger = logging.getLogger('mailhole')
+
+class Command(BaseCommand):
+    help = ('Delete old spam and trash of mailboxes with data retention ' +
+            '"Slet", and the files and packs in MEDIA_ROOT/messages that ' +
+            'no message refers to. Can be interrupted and resumed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Delete messages marked as spam/trash ' +
+                                 'more than this many days ago')
+        parser.add_argument('--status', action='append',
+                            choices=[Message.SPAM, Message.TRASH],
+                            help='Only delete messages with this status ' +
+                                 '(default: spam and trash)')
+        parser.add_argument('--mailbox', action='append',
+                            help='Only delete messages in this mailbox')
+        parser.add_argument('--all-mailboxes', action='store_true',
+                            help='Also delete from mailboxes with data ' +
+                                 'retention "Behold"')
+        parser.add_argument('--orphans', action='store_true',
+                            help='Also delete unreferenced message files')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count what would be deleted but don't " +
+                                 'delete anything')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError('--days must not be negative')
+        qs = self.get_queryset(options)
+        self.dry_run = options['dry_run']
+        self.purge_messages(qs, options['batch_size'])
+        if options['orphans']:
+            self.purge_orphans(options['batch_size'])
+
+    def get_queryset(self, options):
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        qs = Message.objects.filter(
+            status__in=options['status'] or [Message.SPAM, Message.TRASH])
+        qs = qs.filter(Q(status_on__lt=cutoff) |
+                       Q(status_on__isnull=True, created_time__lt=cutoff))
+        if not options['all_mailboxes']:
+            qs = qs.filter(mailbox__data_retention=Mailbox.DELETE)
+        if options['mailbox']:
+            qs = qs.filter(mailbox__name__in=options['mailbox'])
+        return qs
+
+    def purge_messages(self, qs, batch_size):
+        total = qs.count()
+        if self.dry_run:
+            self.stdout.write('Would delete %d messages' % total)
+            return
+        qs = qs.order_by('pk').values_list(
+            'pk', 'created_time', 'message_file', 'orig_message_file')
+        done = files = 0
+        last_pk = 0
+        while True:
+            batch = list(qs.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            pks = [pk for pk, created_time, f1, f2 in batch]
+            # Each batch is committed before its files are deleted, so an
+            # interrupted run leaves no message without its files, only
+            # orphaned files for --orphans to delete.
+            with transaction.atomic():
+                Message.objects.filter(pk__in=pks).delete()
+            # Files in packs are overwritten with zeros, and the packs are
+            # deleted by --orphans once all their files are unused.
+            # A file reused after the newest of the deleted messages
+            # referring to it was created may be about to be referred to
+            # by a new message, see Message.delete_file.
+            touched_before = {}
+            for pk, created_time, f1, f2 in batch:
+                for name in (f1, f2):
+                    if name:
+                        touched_before[name] = max(
+                            created_time,
+                            touched_before.get(name, created_time))
+            files += self.delete_unreferenced_files(touched_before)
+            done += len(batch)
+            self.stdout.write('\r[%6d/%d]' % (done, total), ending='')
+            self.stdout.flush()
+        self.stdout.write('')
+        logger.info('purge_messages: deleted %s messages and %s files',
+                    done, files)
+        self.stdout.write('Deleted %d messages and %d files' % (done, files))
+
+    def purge_orphans(self, batch_size):
+        cutoff = timezone.now() - Message.ORPHAN_MIN_AGE
+        orphans = 0
+        batch = []
+        for name in self.walk('messages'):
+            if name.startswith(PACK_DIR + '/'):
+                orphans += self.purge_orphan_pack(name, cutoff)
+                continue
+            batch.append(name)
+            if len(batch) >= batch_size:
+                orphans += self.purge_orphan_batch(batch, cutoff)
+                batch = []
+        orphans += self.purge_orphan_batch(batch, cutoff)
+        if self.dry_run:
+            self.stdout.write('Would delete %d orphaned files' % orphans)
+        else:
+            logger.info('purge_messages: deleted %s orphaned files', orphans)
+            self.stdout.write('Deleted %d orphaned files' % orphans)
+
+    def purge_orphan_batch(self, names, cutoff):
+        if not self.dry_run:
+            return self.delete_unreferenced_files(
+                dict.fromkeys(names, cutoff))
+        orphans = [name for name in Message.unreferenced_files(names)
+                   if default_storage.get_modified_time(name) < cutoff]
+        return len(orphans)
+
+    def purge_orphan_pack(self, name, cutoff):
+        '''
+        Delete a pack written by ./manage.py pack_messages if no message
+        refers to any file in it, or a pack left unfinished by a crash.
+        '''
+        if name.endswith('.idx'):
+            # Deleted together with its pack.
+            return 0
+        if default_storage.get_modified_time(name) >= cutoff:
+            return 0
+        if name.endswith('.pack'):
+            prefix = name + PACK_SEP
+            referenced = Message.objects.filter(
+                Q(message_file__startswith=prefix) |
+                Q(orig_message_file__startswith=prefix))
+            if referenced.exists():
+                return 0
+            if not self.dry_run:
+                self.delete_files([name, name + '.idx'])
+            return 1
+        if name.endswith('.tmp'):
+            if not self.dry_run:
+                self.delete_files([name])
+            return 1
+        return 0
+
+    def walk(self, path):
+        if not default_storage.exists(path):
+            return
+        dirs, files = default_storage.listdir(path)
+        for filename in sorted(files):
+            yield posixpath.join(path, filename)
+        for dirname in sorted(dirs):
+            yield from self.walk(posixpath.join(path, dirname))
+
+    def delete_unreferenced_files(self, touched_before):
+        '''
+        touched_before maps file names to the time passed to
+        Message.delete_unreferenced_file.
+        '''
+        n = 0
+        for name in Message.unreferenced_files(touched_before):
+            try:
+                n += Message.delete_unreferenced_file(name,
+                                                      touched_before[name])
+            except Exception:
+                logger.exception('purge_messages: could not delete %r', name)
+        return n
+
+    def delete_files(self, names):
+        n = 0
+        for name in names:
+            try:
+                default_storage.delete(name)
+            except Exception:
+                logger.exception('purge_messages: could not delete %r', name)
+            else:
+                n += 1
+        return n
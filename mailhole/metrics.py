@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import logging
+import threading
+import contextlib
+
+from django.conf import settings
+
+
+logger = logging.getLogger('mailhole')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"')
+                     .replace('\n', r'\n'))
+        for k, v in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class Metric:
+    type = None
+    # Appended to the name in the HELP and TYPE lines and the samples.
+    suffix = ''
+    # Whether the values are kept in memory (and flushed to METRICS_DIR).
+    stored = True
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s has labels %s, not %s' %
+                             (self.name, self.labelnames, tuple(labels)))
+        return tuple((k, labels[k]) for k in self.labelnames)
+
+    def _changed(self):
+        global _dirty
+        _dirty = True
+
+    def _copy_value(self, value):
+        return value
+
+    def _add_values(self, a, b):
+        return a + b
+
+    def _load_value(self, value):
+        return value
+
+    def dump(self):
+        '''
+        Return the values of this process as a JSON-serializable list.
+        '''
+        with self._lock:
+            return [[list(map(list, key)), value]
+                    for key, value in self._values.items()]
+
+    def values(self, others=()):
+        '''
+        Return the sorted (key, value) of this process, added to others,
+        the dump() of other processes.
+        '''
+        with self._lock:
+            values = {key: self._copy_value(value)
+                      for key, value in self._values.items()}
+        for dump in others:
+            for key, value in dump:
+                key = tuple(tuple(pair) for pair in key)
+                value = self._load_value(value)
+                if key in values:
+                    value = self._add_values(values[key], value)
+                values[key] = value
+        return sorted(values.items())
+
+    def samples(self, others=()):
+        '''
+        Return a list of (suffix, labels, value).
+        '''
+        raise NotImplementedError
+
+    def render(self, others=()):
+        name = self.name + self.suffix
+        lines = ['# HELP %s %s' % (name, self.help),
+                 '# TYPE %s %s' % (name, self.type)]
+        for suffix, labels, value in self.samples(others):
+            lines.append('%s%s%s %s' % (name, suffix,
+                                        _format_labels(labels),
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+    suffix = '_total'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        self._changed()
+
+    def samples(self, others=()):
+        values = self.values(others)
+        if not self.labelnames and not values:
+            values = [((), 0)]
+        return [('', key, value) for key, value in values]
+
+
+class Gauge(Metric):
+    '''
+    A metric whose values are computed by collect(), a function that
+    returns a list of (labels dict, value), when the metrics are rendered.
+    '''
+    type = 'gauge'
+    stored = False
+
+    def __init__(self, name, help, labelnames, collect):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+
+    def samples(self, others=()):
+        return [('', self._key(labels), value)
+                for labels, value in self.collect()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            try:
+                counts, total = self._values[key]
+            except KeyError:
+                counts, total = [0] * len(self.buckets), 0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = counts, total + value
+        self._changed()
+
+    def _copy_value(self, value):
+        counts, total = value
+        return list(counts), total
+
+    def _add_values(self, a, b):
+        return [x + y for x, y in zip(a[0], b[0])], a[1] + b[1]
+
+    def _load_value(self, value):
+        counts, total = value
+        return counts, total
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t, **labels)
+
+    def samples(self, others=()):
+        values = self.values(others)
+        if not self.labelnames and not values:
+            values = [((), ([0] * len(self.buckets), 0))]
+        samples = []
+        for key, (counts, total) in values:
+            n = 0
+            for bound, count in zip(self.buckets, counts):
+                n += count
+                le = _format_value(bound)
+                samples.append(('_bucket', key + (('le', le),), n))
+            samples.append(('_sum', key, total))
+            samples.append(('_count', key, n))
+        return samples
+
+
+# The metrics rendered by mailhole.views.Metrics. Except for gauges, which
+# are computed when rendered, the values are kept in memory per process.
+# If settings.METRICS_DIR is set, each process writes its values to a file
+# there with flush(), and render() adds up the files of all processes.
+REGISTRY = []
+
+# Whether a value has changed since the last flush().
+_dirty = False
+_flush_lock = threading.Lock()
+# (pid, file name) of this process. The name is unique to the process, so
+# the values of a process that has exited are kept, and counters don't
+# decrease when a worker is restarted or a pid is reused.
+_process_file = None
+
+
+def _file_name():
+    global _process_file
+    pid = os.getpid()
+    if _process_file is None or _process_file[0] != pid:
+        # Also reached in a worker that was forked after import.
+        _process_file = pid, '%s-%s.json' % (pid, uuid.uuid4().hex[:8])
+    return _process_file[1]
+
+
+def flush():
+    '''
+    Write the values of this process to its file in settings.METRICS_DIR,
+    if they have changed. Called at the end of every request by
+    mailhole.instrumentation.InstrumentationMiddleware.
+    '''
+    global _dirty
+    directory = settings.METRICS_DIR
+    if not directory or not _dirty:
+        return
+    with _flush_lock:
+        _dirty = False
+        data = {m.name: m.dump() for m in REGISTRY if m.stored}
+        path = os.path.join(directory, _file_name())
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(path + '.tmp', 'w') as fp:
+                json.dump(data, fp)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            _dirty = True
+            logger.exception('Could not write metrics to %s', path)
+
+
+atexit.register(flush)
+
+
+def _read_other_processes():
+    '''
+    Return a dict mapping metric name to the list of dump()s of the other
+    processes that have written to settings.METRICS_DIR.
+    '''
+    directory = settings.METRICS_DIR
+    others = {}
+    if not directory:
+        return others
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return others
+    own = _file_name()
+    for name in names:
+        if not name.endswith('.json') or name == own:
+            continue
+        try:
+            with open(os.path.join(directory, name)) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            logger.exception('Could not read metrics from %s', name)
+            continue
+        for metric_name, dump in data.items():
+            others.setdefault(metric_name, []).append(dump)
+    return others
+
+
+def render():
+    others = _read_other_processes()
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render(others.get(metric.name, ())))
+    return '\n'.join(lines) + '\n'
+
+
+def _inbox_sizes():
+    from django.db.models import Count
+    from mailhole.models import Message
+
+    qs = Message.objects.filter(status=Message.INBOX)
+    qs = qs.values_list('mailbox__name').annotate(count=Count('pk'))
+    return [(dict(mailbox=name), count)
+            for name, count in qs.order_by('mailbox__name')]
+
+
+messages_ingested = Counter(
+    'mailhole_messages_ingested', 'Messages stored by Message.create',
+    ['peer'])
+filter_seconds = Histogram(
+    'mailhole_filter_seconds', 'Time to find the FilterRule of a message',
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1))
+filter_rule_hits = Counter(
+    'mailhole_filter_rule_hits', 'Messages matched by each FilterRule',
+    ['rule', 'action'])
+forwards = Counter(
+    'mailhole_forwards', 'Forwards sent (one per recipient)',
+    ['mailbox'])
+smtp_send_seconds = Histogram(
+    'mailhole_smtp_send_seconds', 'Time to send a forwarded message')
+smtp_failures = Counter(
+    'mailhole_smtp_failures', 'Forwards that could not be sent')
+inbox_messages = Gauge(
+    'mailhole_inbox_messages', 'Messages in the inbox of each mailbox',
+    ['mailbox'], _inbox_sizes)
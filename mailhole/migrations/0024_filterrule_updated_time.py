@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 22:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailhole', '0023_mailbox_data_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filterrule',
+            name='updated_time',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 22:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailhole', '0025_forwardqueueitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='header_from',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='header_from_address',
+            field=models.CharField(blank=True, db_index=True, max_length=190, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='header_subject',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='header_to_people',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 22:19
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import mailhole.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailhole', '0027_message_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='message_file',
+            field=models.FileField(db_index=True, upload_to=mailhole.models.message_upload_to),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='orig_message_file',
+            field=models.FileField(db_index=True, null=True, upload_to=mailhole.models.orig_message_upload_to),
+        ),
+    ]
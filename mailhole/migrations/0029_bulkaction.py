@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 22:30
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mailhole', '0028_message_file_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkAction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_time', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(choices=[('inbox', 'Indbakke'), ('spam', 'Spam'), ('trash', 'Slettet')], max_length=10)),
+                ('sender', models.CharField(blank=True, help_text='Blank betyder "alle afsendere"', max_length=190)),
+                ('action', models.CharField(choices=[('spam', 'Markér som spam'), ('trash', 'Slet')], max_length=10)),
+                ('total', models.IntegerField(default=0)),
+                ('done', models.IntegerField(default=0)),
+                ('last_pk', models.IntegerField(default=0)),
+                ('finished_time', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('mailboxes', models.ManyToManyField(to='mailhole.Mailbox')),
+                ('peer', models.ForeignKey(blank=True, help_text='Blank betyder "alle servere"', null=True, on_delete=django.db.models.deletion.CASCADE, to='mailhole.Peer')),
+            ],
+        ),
+    ]
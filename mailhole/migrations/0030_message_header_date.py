@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.3 on 2026-10-17 22:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailhole', '0029_bulkaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='header_date',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -1,13 +1,18 @@
+import os
 import re
+import json
 import email
+import datetime
+import string
+import hashlib
 import logging
 
 import django.core.mail
 from django.core.mail import EmailMessage
 from django.core.mail.message import MIMEMixin
 from django.conf import settings
-from django.db import models
-from django.db.models import Max
+from django.db import models, transaction
+from django.db.models import Max, Count, Q
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
@@ -15,8 +20,12 @@ from django.core.files.base import ContentFile
 from django.utils import html, timezone
 
 from mailhole.utils import html_to_plain, decode_any_header
+from mailhole.instrumentation import timer, STORAGE, MIME, SMTP
+from mailhole.storage import blob_lock, split_packed_name
 import mailhole.policy
+import mailhole.metrics
 import email.utils
+from email.parser import BytesFeedParser
 
 
 logger = logging.getLogger('mailhole')
@@ -92,12 +101,30 @@ class Mailbox(models.Model):
         else:
             return cls.objects.filter(readers=user)
 
+    @classmethod
+    def count_folders(cls, mailboxes):
+        '''
+        Set folder_counts on each of the given mailboxes to a dict mapping
+        status to number of messages, using a single query.
+        '''
+        counts = {mailbox.pk: {} for mailbox in mailboxes}
+        qs = Message.objects.filter(mailbox__in=mailboxes)
+        qs = qs.values('mailbox_id', 'status').annotate(count=Count('pk'))
+        for row in qs.order_by():
+            counts[row['mailbox_id']][row['status']] = row['count']
+        for mailbox in mailboxes:
+            mailbox.folder_counts = counts[mailbox.pk]
+
     def folders(self):
+        try:
+            counts = self.folder_counts
+        except AttributeError:
+            Mailbox.count_folders([self])
+            counts = self.folder_counts
         for key, label in Message.STATUS:
             url = reverse('mailbox_message_list',
                           kwargs=dict(mailbox=self.name, status=key))
-            qs = self.message_set.filter(status=key)
-            yield key, label, url, qs
+            yield key, label, url, counts.get(key, 0)
 
     def get_absolute_url(self):
         return reverse('mailbox_detail',
@@ -157,6 +184,11 @@ class FilterRule(models.Model):
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL,
                                    blank=False, null=True)
     created_time = models.DateTimeField(auto_now_add=True)
+    updated_time = models.DateTimeField(auto_now=True, null=True)
+
+    # Process-level cache of CompiledFilterRules, see compiled_for_peer.
+    _compiled_version = None
+    _compiled_by_peer = {}
 
     def __str__(self):
         return '%s (%s)' % (self.pattern, self.get_kind_display())
@@ -195,14 +227,23 @@ class FilterRule(models.Model):
 
         Filters are applied in the order given and stops at first match.
         '''
+        sender, subject, header_strs = cls.message_strings(message)
+        for filter in filters:
+            if filter._match_message(sender, subject, header_strs):
+                return filter
+
+    @staticmethod
+    def message_strings(message):
+        '''
+        Returns the (sender, subject, header_strs) that FilterRules of kind
+        SENDER_MATCH, SUBJECT_MATCH and HEADER_MATCH are matched against.
+        '''
         sender = message.orig_mail_from
         headers = message.parsed_headers
         subject = headers.get('Subject') or ''
         header_strs = ['%s: %s' % (k, decode_any_header(v))
                        for k, v in headers.items()]
-        for filter in filters:
-            if filter._match_message(sender, subject, header_strs):
-                return filter
+        return sender, subject, header_strs
 
     def _match_message(self, sender, subject, header_strs):
         if self.kind == FilterRule.SUBJECT_MATCH:
@@ -214,35 +255,321 @@ class FilterRule(models.Model):
         else:
             raise Exception(self.kind)
 
+    @classmethod
+    def compiled_for_peer(cls, peer):
+        '''
+        Returns the CompiledFilterRules that apply to messages from peer.
+
+        The compiled rules are kept for the lifetime of the process and
+        rebuilt when a FilterRule is added, changed or deleted, which is
+        detected with a single aggregate query. This also catches changes
+        made by other processes, e.g. another web worker.
+        '''
+        version = cls.objects.aggregate(
+            count=Count('pk'), max_pk=Max('pk'),
+            updated_time=Max('updated_time'))
+        version = (version['count'], version['max_pk'],
+                   version['updated_time'])
+        if version != cls._compiled_version:
+            cls._compiled_by_peer = {}
+            cls._compiled_version = version
+        try:
+            return cls._compiled_by_peer[peer.pk]
+        except KeyError:
+            pass
+        filters = (cls.objects.filter(peer=None) |
+                   cls.objects.filter(peer=peer))
+        filters = filters.order_by('order')
+        compiled = CompiledFilterRules(filters)
+        cls._compiled_by_peer[peer.pk] = compiled
+        return compiled
+
     def match_string(self, text):
         return bool(re.search(self.pattern, text, re.I))
 
     @classmethod
     def whitelist_from(cls, message, user):
+        cls.whitelist_from_many([message], user)
+
+    @classmethod
+    def whitelist_from_many(cls, messages, user):
+        '''
+        Create a FORWARD rule for the From header of each of the messages
+        (one rule per distinct From) using a single INSERT.
+        '''
         max_order = cls.objects.all().aggregate(order=Max('order'))['order']
         if max_order is None:
             # No objects exist yet
             max_order = 0
-        order = max_order + 1
-        from_ = message.from_()
-        filter = cls(order=order,
-                     kind=FilterRule.HEADER_MATCH,
-                     pattern='^From: %s$' % re.escape(from_),
-                     examples='From: %s' % (from_,),
-                     action=FilterRule.FORWARD,
-                     created_by=user)
-        test = FilterRule.filter_message([filter], message)
-        if test is None:
-            raise Exception('FilterRule.filter_message failed')
-        filter.save()
-        logger.info('user:%s (%s) filter:%s whitelisted %r',
-                    user.pk, user.username, filter.pk, from_)
+        filters = []
+        for message in messages:
+            from_ = message.from_()
+            pattern = '^From: %s$' % re.escape(from_)
+            if any(f.pattern == pattern for f in filters):
+                continue
+            filter = cls(order=max_order + 1 + len(filters),
+                         kind=FilterRule.HEADER_MATCH,
+                         pattern=pattern,
+                         examples='From: %s' % (from_,),
+                         action=FilterRule.FORWARD,
+                         created_by=user)
+            test = FilterRule.filter_message([filter], message)
+            if test is None:
+                raise Exception('FilterRule.filter_message failed')
+            filters.append(filter)
+        cls.objects.bulk_create(filters)
+        for filter in filters:
+            logger.info('user:%s (%s) filter order:%s whitelisted %r',
+                        user.pk, user.username, filter.order,
+                        filter.examples[len('From: '):])
+
+
+class CompiledFilterRules:
+    '''
+    A sequence of FilterRules with their patterns compiled once.
+
+    HEADER_MATCH rules of the form ^literal$, such as the ones created by
+    FilterRule.whitelist_from, are looked up in a dict keyed by the header
+    line, so they cost O(1) per header regardless of how many there are.
+
+    The remaining rules of the same kind are joined into one alternation,
+    which rules out every rule of that kind with a single regex search per
+    string. Only if the alternation matches are the rules tried one by one,
+    so match() returns the same rule as FilterRule.filter_message.
+    '''
+
+    _FLAGS = re.compile('', re.I).flags
+    _SPECIAL = frozenset('.^$*+?{}[]\\|()')
+    _ESCAPABLE_ALNUM = frozenset(string.ascii_letters + string.digits)
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self.regexes = [re.compile(f.pattern, re.I) for f in self.filters]
+        # Map casefolded header line to the indices, in order, of the rules
+        # that may match it. Casefolding is more lenient than re.I (e.g.
+        # "ß" and "SS"), so several rules may share a key without matching
+        # the same headers.
+        self.exact_headers = {}
+        self.indexed = []
+        for i, f in enumerate(self.filters):
+            literal = None
+            if f.kind == FilterRule.HEADER_MATCH:
+                literal = self._exact_literal(f.pattern)
+            self.indexed.append(literal is not None)
+            if literal is not None:
+                self.exact_headers.setdefault(
+                    literal.casefold(), []).append(i)
+        # Rules whose pattern is not part of the combined alternation
+        # of their kind must always be tried individually.
+        self.combinable = [
+            not indexed and self._is_combinable(r)
+            for indexed, r in zip(self.indexed, self.regexes)]
+        self.combined = {}
+        for kind, label in FilterRule.KIND:
+            self.combined[kind] = self._combine(
+                [r for f, r, c in zip(self.filters, self.regexes,
+                                      self.combinable)
+                 if f.kind == kind and c])
+
+    @classmethod
+    def _exact_literal(cls, pattern):
+        '''
+        If pattern is ^literal$ with no special characters in literal
+        except escaped ones, return literal. Otherwise, return None.
+        '''
+        if len(pattern) < 2 or pattern[0] != '^' or pattern[-1] != '$':
+            return None
+        body = pattern[1:-1]
+        literal = []
+        i = 0
+        while i < len(body):
+            c = body[i]
+            if c == '\\':
+                # Handles both Python 3.6 re.escape, which escapes
+                # everything except ASCII letters and digits, and Python 3.7
+                # re.escape, which only escapes special characters.
+                # A trailing backslash means that the final $ is escaped.
+                if i + 1 == len(body) or body[i + 1] in cls._ESCAPABLE_ALNUM:
+                    return None
+                literal.append(body[i + 1])
+                i += 2
+            elif c in cls._SPECIAL:
+                return None
+            else:
+                literal.append(c)
+                i += 1
+        return ''.join(literal)
+
+    @classmethod
+    def _is_combinable(cls, regex):
+        # A pattern with groups could contain backreferences, which would be
+        # renumbered, and global inline flags like (?s) would apply to all
+        # the other patterns in the alternation.
+        return regex.groups == 0 and regex.flags == cls._FLAGS
+
+    @classmethod
+    def _combine(cls, regexes):
+        if not regexes:
+            return None
+        patterns = ['(?:%s)' % r.pattern for r in regexes]
+        try:
+            return re.compile('|'.join(patterns), re.I)
+        except re.error:
+            return None
+
+    def _kind_may_match(self, kind, sender, subject, header_strs):
+        combined = self.combined[kind]
+        if combined is None:
+            # The alternation could not be compiled; try each rule.
+            return True
+        if kind == FilterRule.SUBJECT_MATCH:
+            return bool(combined.search(subject))
+        elif kind == FilterRule.SENDER_MATCH:
+            return bool(combined.search(sender))
+        elif kind == FilterRule.HEADER_MATCH:
+            return any(map(combined.search, header_strs))
+        else:
+            raise Exception(kind)
+
+    def _first_exact_match(self, header_strs):
+        '''
+        Returns the index of the first indexed rule matching a header, if any.
+        '''
+        first = None
+        for header_str in header_strs:
+            # $ also matches before a trailing newline.
+            keys = [header_str]
+            if header_str.endswith('\n'):
+                keys.append(header_str[:-1])
+            for key in keys:
+                for i in self.exact_headers.get(key.casefold(), ()):
+                    if first is not None and first <= i:
+                        break
+                    # Confirm the candidate with the actual regex.
+                    if self.regexes[i].search(header_str):
+                        first = i
+                        break
+        return first
+
+    def match(self, message):
+        '''
+        Returns the first FilterRule in order that matches message, if any.
+        '''
+        sender, subject, header_strs = FilterRule.message_strings(message)
+        first_exact = self._first_exact_match(header_strs)
+        may_match = {}
+        for i, (filter, regex, indexed, combinable) in enumerate(zip(
+                self.filters, self.regexes, self.indexed, self.combinable)):
+            if i == first_exact:
+                return filter
+            if indexed:
+                continue
+            if combinable:
+                try:
+                    kind_may_match = may_match[filter.kind]
+                except KeyError:
+                    kind_may_match = may_match[filter.kind] = (
+                        self._kind_may_match(filter.kind, sender, subject,
+                                             header_strs))
+                if not kind_may_match:
+                    continue
+            if filter.kind == FilterRule.SUBJECT_MATCH:
+                texts = [subject]
+            elif filter.kind == FilterRule.SENDER_MATCH:
+                texts = [sender]
+            elif filter.kind == FilterRule.HEADER_MATCH:
+                texts = header_strs
+            else:
+                raise Exception(filter.kind)
+            if any(map(regex.search, texts)):
+                return filter
 
 
 class DjangoMessage(MIMEMixin, email.message.Message):
     pass
 
 
+class StoredMessage(DjangoMessage):
+    '''
+    A message whose headers are parsed from a header section and whose
+    body is left in storage until the message is serialized.
+
+    as_bytes() returns the stored file as it is (with line endings
+    normalised to CR LF), unless the headers have been changed (e.g. by
+    mailhole.policy.rewrite_message), in which case the changed headers are
+    spliced into the stored header section.
+    '''
+
+    @classmethod
+    def from_stored(cls, headers, field_file):
+        with timer(MIME):
+            message = email.message_from_string(headers, cls)
+        message._field_file = field_file
+        message._stored_headers = list(message._headers)
+        return message
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        if unixfrom:
+            raise ValueError('unixfrom is not supported')
+        with timer(STORAGE):
+            self._field_file.open('rb')
+            try:
+                data = self._field_file.read()
+            finally:
+                self._field_file.close()
+        if data.count(b'\n') != data.count(b'\r\n'):
+            # The SMTP backend sends the bytes as they are, so bare LFs
+            # must be normalised here.
+            data = re.sub(br'\r?\n', b'\r\n', data)
+        if self._headers != self._stored_headers:
+            header_end = data.find(b'\r\n\r\n')
+            if header_end == -1:
+                header_end = len(data)
+            body = data[header_end+4:]
+            with timer(MIME):
+                headers = self._splice_headers(data[:header_end+2])
+            data = b''.join(headers + [b'\r\n', body])
+        if linesep != '\r\n':
+            data = data.replace(b'\r\n', linesep.encode())
+        return data
+
+    def _splice_headers(self, header_bytes):
+        '''
+        Return the fields of the header section as a list of bytes, taking
+        the headers that were not changed from header_bytes, so that 8-bit
+        bytes that outgoing_headers decoded as U+FFFD are kept.
+        '''
+        raw_fields = []
+        for line in header_bytes.splitlines(keepends=True):
+            if raw_fields and line[:1] in (b' ', b'\t'):
+                raw_fields[-1] += line
+            else:
+                raw_fields.append(line)
+        names = [f.split(b':', 1)[0].strip().lower() for f in raw_fields]
+        stored_names = [k.lower().encode('ascii', errors='replace')
+                        for k, v in self._stored_headers]
+        if names != stored_names:
+            # The fields don't line up with the parsed headers (e.g. a
+            # malformed header line), so regenerate all of them.
+            raw_fields = [None] * len(self._stored_headers)
+        policy = self.policy.clone(linesep='\r\n')
+        result = []
+        used = set()
+        for k, v in self._headers:
+            for i, stored in enumerate(self._stored_headers):
+                if i not in used and stored == (k, v) and raw_fields[i]:
+                    used.add(i)
+                    result.append(raw_fields[i])
+                    break
+            else:
+                result.append(policy.fold_binary(k, v))
+        return result
+
+    def as_string(self, unixfrom=False, linesep='\n'):
+        return self.as_bytes(unixfrom, linesep).decode(
+            'ascii', errors='surrogateescape')
+
+
 def message_upload_to(message: 'Message', filename, suffix=''):
     return 'messages/{peer}/{mailbox}/{now}{suffix}.mail'.format(
         peer=message.peer.slug,
@@ -279,13 +606,29 @@ class Message(models.Model):
     orig_mail_from = models.CharField(max_length=256,
                                       blank=False, null=True)
     orig_rcpt_tos = models.TextField(blank=False, null=True)
-    message_file = models.FileField(upload_to=message_upload_to)
+    # Files are stored by Message.store_blob and shared between messages
+    # with identical content. The indexes are used by file_references.
+    message_file = models.FileField(upload_to=message_upload_to,
+                                    db_index=True)
     orig_message_file = models.FileField(upload_to=orig_message_upload_to,
-                                         blank=False, null=True)
+                                         blank=False, null=True,
+                                         db_index=True)
     headers = models.TextField(help_text="From orig_message_file")
     outgoing_headers = models.TextField(help_text="From message_file")
     # Unfortunately, MySQL makes it difficult to index more than 190 bytes :-(
     message_id = models.CharField(max_length=190, db_index=True, blank=True, null=True)
+    # Decoded from headers by extract_header_fields so that displaying a
+    # message doesn't parse its headers. None if not yet populated
+    # (see ./manage.py populate_header_fields).
+    header_subject = models.TextField(blank=True, null=True)
+    header_from = models.TextField(blank=True, null=True)
+    header_from_address = models.CharField(max_length=190, db_index=True,
+                                           blank=True, null=True)
+    # JSON list of [formatted, abbreviated] pairs, see to_people.
+    header_to_people = models.TextField(blank=True, null=True)
+    header_date = models.TextField(blank=True, null=True)
+    HEADER_FIELDS = ('header_subject', 'header_from', 'header_from_address',
+                     'header_to_people', 'header_date')
     body_text_bytes = models.BinaryField(null=True)
     created_time = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=10, choices=STATUS,
@@ -296,6 +639,18 @@ class Message(models.Model):
                                     blank=True, null=True)
     status_on = models.DateTimeField(blank=True, null=True)
 
+    class Meta:
+        # Indexes for the hot queries checked by
+        # ./manage.py check_query_plans.
+        indexes = [
+            # MailboxMessageList and Mailbox.count_folders
+            models.Index(fields=['mailbox', 'status', 'created_time']),
+            # MessageList (all mailboxes) and monitor.py
+            models.Index(fields=['status', 'created_time']),
+            # exists_earlier_identical_forwarded_message
+            models.Index(fields=['message_id', 'status', 'created_time']),
+        ]
+
     def __str__(self):
         return '<Message %s %r>' % (self.created_time.isoformat(),
                                     self.subject())
@@ -303,6 +658,14 @@ class Message(models.Model):
     @classmethod
     def create(cls, peer, mail_from, rcpt_tos, message_bytes,
                orig_mail_from, orig_rcpt_tos, orig_message_bytes):
+        '''
+        message_bytes and orig_message_bytes are bytes or Django File objects
+        (e.g. uploaded files), which are only ever read in chunks.
+        '''
+        if isinstance(message_bytes, bytes):
+            message_bytes = ContentFile(message_bytes)
+        if isinstance(orig_message_bytes, bytes):
+            orig_message_bytes = ContentFile(orig_message_bytes)
         if not isinstance(rcpt_tos, list):
             raise ValueError('rcpt_tos must be a list, not a %r' %
                              (type(rcpt_tos),))
@@ -317,23 +680,113 @@ class Message(models.Model):
                       status=cls.INBOX,
                       orig_mail_from=orig_mail_from,
                       orig_rcpt_tos=Message.RECIPIENT_SEP.join(orig_rcpt_tos))
-        message.message_file.save('message.msg', ContentFile(message_bytes))
-        message.orig_message_file.save('orig_message.msg',
-                                       ContentFile(orig_message_bytes))
-        message.extract_message_data()
+        # Extract from the submitted files rather than reading them back
+        # from storage, and before writing anything, so that an invalid
+        # message leaves no files behind.
+        message.extract_message_data(orig_content=orig_message_bytes,
+                                      content=message_bytes)
         message.clean()
+        message.message_file = cls.store_blob(message_bytes)
+        message.orig_message_file = cls.store_blob(orig_message_bytes)
         message.save()
         logger.info("message:%s msgid:%s peer:%s To: %s",
                     message.pk, message.message_id, peer.slug, message.orig_rcpt_tos)
+        mailhole.metrics.messages_ingested.inc(peer=peer.slug)
         return message
 
+    # Message.create stores the files before the Message is saved, so a file
+    # stored or reused more recently than this may not be an orphan.
+    ORPHAN_MIN_AGE = datetime.timedelta(hours=1)
+
+    @staticmethod
+    def store_blob(content):
+        '''
+        Store content under a name derived from its SHA-256 and return
+        the name. Identical content (e.g. message and orig_message, or the
+        copies made by SubmitForm.save for each domain) is stored once.
+        '''
+        if isinstance(content, bytes):
+            content = ContentFile(content)
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        name = 'messages/blobs/%s/%s.mail' % (digest[:2], digest)
+        storage = Message._meta.get_field('message_file').storage
+        with blob_lock(storage, exclusive=False):
+            # A blob of the wrong size was left half-written by a crash
+            # and is replaced below.
+            if storage.exists(name) and storage.size(name) == content.size:
+                # The Message that will refer to the blob is not saved yet,
+                # so tell delete_unreferenced_file that it is in use.
+                os.utime(storage.path(name))
+                return name
+            # Write to a temporary name (storage.save() copies content in
+            # chunks) and rename, so the blob is never seen half-written.
+            tmp_name = storage.save(name + '.tmp', content)
+            os.replace(storage.path(tmp_name), storage.path(name))
+        return name
+
+    @staticmethod
+    def file_references(name):
+        return Message.objects.filter(Q(message_file=name) |
+                                      Q(orig_message_file=name))
+
+    def delete_file(self, field_file):
+        '''
+        Clear field_file (self.message_file or self.orig_message_file) and
+        delete it from storage unless another Message refers to it.
+        Doesn't save self.
+        '''
+        name = field_file.name
+        if not name:
+            return
+        setattr(self, field_file.field.name, None)
+        if not Message.file_references(name).exclude(pk=self.pk).exists():
+            # If the file is reused after self was created, the Message
+            # reusing it may not be saved yet.
+            Message.delete_unreferenced_file(name, self.created_time)
+
+    @staticmethod
+    def delete_unreferenced_file(name, touched_before):
+        '''
+        Delete the file name, which no saved Message refers to, unless
+        store_blob has reused it since touched_before.
+        Returns True if the file was deleted.
+        '''
+        storage = Message._meta.get_field('message_file').storage
+        with blob_lock(storage, exclusive=True):
+            if not storage.exists(name):
+                return False
+            # store_blob never reuses files in packs.
+            if (split_packed_name(name) is None and
+                    storage.get_modified_time(name) >= touched_before):
+                logger.info('Not deleting %r, which was reused since %s',
+                            name, touched_before)
+                return False
+            storage.delete(name)
+        return True
+
+    @staticmethod
+    def unreferenced_files(names):
+        '''
+        Return the subset of the given file names that no Message refers to.
+        '''
+        names = set(names)
+        referenced = set()
+        for field in ('message_file', 'orig_message_file'):
+            qs = Message.objects.filter(**{field + '__in': names})
+            referenced.update(qs.values_list(field, flat=True))
+        return names - referenced
+
     @property
     def parsed_headers(self):
         try:
             return self._parsed_headers
         except AttributeError:
-            self._parsed_headers = (
-                email.message_from_string(self.headers, DjangoMessage))
+            with timer(MIME):
+                self._parsed_headers = (
+                    email.message_from_string(self.headers, DjangoMessage))
             return self._parsed_headers
 
     @property
@@ -341,8 +794,9 @@ class Message(models.Model):
         try:
             return self._parsed_outgoing_headers
         except AttributeError:
-            self._parsed_outgoing_headers = (
-                email.message_from_string(self.outgoing_headers, DjangoMessage))
+            with timer(MIME):
+                self._parsed_outgoing_headers = email.message_from_string(
+                    self.outgoing_headers, DjangoMessage)
             return self._parsed_outgoing_headers
 
     @property
@@ -353,68 +807,130 @@ class Message(models.Model):
             if self.orig_message_file is None:
                 self._orig_message = self.message
             else:
-                self.orig_message_file.open('rb')
-                self._orig_message = email.message_from_binary_file(
-                    self.orig_message_file, DjangoMessage)
-                self.orig_message_file.close()
+                with timer(STORAGE):
+                    self.orig_message_file.open('rb')
+                    data = self.orig_message_file.read()
+                    self.orig_message_file.close()
+                with timer(MIME):
+                    self._orig_message = email.message_from_bytes(
+                        data, DjangoMessage)
             return self._orig_message
 
+    @property
+    def outgoing_message(self):
+        '''
+        message_file as a StoredMessage, for forwarding without parsing
+        the body.
+        '''
+        try:
+            return self._outgoing_message
+        except AttributeError:
+            self._outgoing_message = StoredMessage.from_stored(
+                self.outgoing_headers, self.message_file)
+            return self._outgoing_message
+
     @property
     def message(self):
         try:
             return self._message
         except AttributeError:
-            self.message_file.open('rb')
-            self._message = email.message_from_binary_file(self.message_file,
-                                                           DjangoMessage)
-            self.message_file.close()
+            with timer(STORAGE):
+                self.message_file.open('rb')
+                data = self.message_file.read()
+                self.message_file.close()
+            with timer(MIME):
+                self._message = email.message_from_bytes(data, DjangoMessage)
             return self._message
 
+    # At most this many bytes of a message are parsed to find its body
+    # text, which bounds the memory used by ingest regardless of the size of
+    # the message. This is also the maximum size of the header section.
+    PARSE_LIMIT = 1024 * 1024
+
     @staticmethod
-    def _extract_message_data(self):
+    def _read_message(content, parse=False):
         '''
-        Set self.headers and self.body_text from self.orig_message_file.
+        Read the header section of content, a Django File, in chunks.
+        If parse is True, also parse at most PARSE_LIMIT bytes of it.
+
+        Returns the header section (including the empty line that ends it)
+        as a str, and the parsed message or None.
         '''
-        self.orig_message_file.open('rb')
-        message_bytes = self.orig_message_file.read()
-        try:
-            header_end = message_bytes.index(b'\r\n\r\n') + 4
-        except ValueError:
-            if message_bytes.endswith(b'\r\n'):
-                header_end = len(message_bytes)
-            else:
-                raise ValidationError('Message must contain CR LF CR LF')
-        self.headers = message_bytes[:header_end].decode(
-            'ascii', errors='replace')
-        try:
-            message = email.message_from_bytes(message_bytes, DjangoMessage)
-        except Exception:
-            raise ValidationError('Could not parse message')
-        self.body_text = Message._get_body_text(self, message)
-        self.orig_message_file.close()
+        header = b''
+        header_end = None
+        parser = BytesFeedParser(DjangoMessage) if parse else None
+        fed = 0
+        for chunk in content.chunks():
+            if header_end is None:
+                search_from = max(0, len(header) - 3)
+                header += chunk
+                i = header.find(b'\r\n\r\n', search_from)
+                if i != -1:
+                    header_end = i + 4
+                    header = header[:header_end]
+                elif len(header) > Message.PARSE_LIMIT:
+                    raise ValidationError('Message header is too large')
+            if parser is not None and fed < Message.PARSE_LIMIT:
+                piece = chunk[:Message.PARSE_LIMIT - fed]
+                try:
+                    with timer(MIME):
+                        parser.feed(piece)
+                except Exception:
+                    raise ValidationError('Could not parse message')
+                fed += len(piece)
+            if header_end is not None and (
+                    parser is None or fed >= Message.PARSE_LIMIT):
+                break
+        if header_end is None and not header.endswith(b'\r\n'):
+            raise ValidationError('Message must contain CR LF CR LF')
+        message = None
+        if parser is not None:
+            try:
+                with timer(MIME):
+                    message = parser.close()
+            except Exception:
+                raise ValidationError('Could not parse message')
+        return header.decode('ascii', errors='replace'), message
+
+    @staticmethod
+    def _extract_message_data(self, orig_content=None, content=None):
+        '''
+        Set self.headers and self.body_text from orig_content
+        and self.outgoing_headers from content (Django File objects).
+        If not given, they are read from self.orig_message_file
+        and self.message_file.
+        '''
+        if orig_content is None:
+            try:
+                self.headers, message = Message._read_message(
+                    self.orig_message_file, parse=True)
+            finally:
+                self.orig_message_file.close()
+        else:
+            self.headers, message = Message._read_message(
+                orig_content, parse=True)
+        with timer(MIME):
+            self.body_text = Message._get_body_text(self, message)
         self.extract_header_fields()
-        self._extract_outgoing_headers(self)
+        self._extract_outgoing_headers(self, content)
 
     @staticmethod
-    def _extract_outgoing_headers(self):
+    def _extract_outgoing_headers(self, content=None):
         '''
-        Set self.outgoing_headers from self.message_file.
+        Set self.outgoing_headers from content (a Django File),
+        or if None, from self.message_file.
         '''
-        self.message_file.open('rb')
-        message_bytes = self.message_file.read()
-        try:
-            header_end = message_bytes.index(b'\r\n\r\n') + 4
-        except ValueError:
-            if message_bytes.endswith(b'\r\n'):
-                header_end = len(message_bytes)
-            else:
-                raise ValidationError('Message must contain CR LF CR LF')
-        self.outgoing_headers = message_bytes[:header_end].decode(
-            'ascii', errors='replace')
-        self.message_file.close()
+        if content is None:
+            try:
+                self.outgoing_headers, _ = Message._read_message(
+                    self.message_file)
+            finally:
+                self.message_file.close()
+        else:
+            self.outgoing_headers, _ = Message._read_message(content)
 
-    def extract_message_data(self):
-        self._extract_message_data(self)
+    def extract_message_data(self, orig_content=None, content=None):
+        self._extract_message_data(self, orig_content, content)
 
     def extract_header_fields(self):
         message_id = self.parsed_headers.get("Message-ID")
@@ -426,6 +942,20 @@ class Message(models.Model):
             # silly behavior in MySQL.
             message_id = message_id[:190]
         self.message_id = message_id
+        self.header_subject = self._decode_subject()
+        self.header_from = self._decode_from()
+        self.header_from_address = self._parse_from_address()[:190]
+        self.header_to_people = json.dumps(list(self._parse_to_people()))
+        self.header_date = self._parse_date()
+
+    def scrub_header_fields(self):
+        '''
+        Clear the header_* fields of a message whose headers have been
+        scrubbed by mailhole.policy.data_retention_after_send.
+        '''
+        for field in Message.HEADER_FIELDS:
+            setattr(self, field, "")
+        self.header_to_people = "[]"
 
     @property
     def body_text(self):
@@ -439,6 +969,11 @@ class Message(models.Model):
     def from_(self):
         if self.headers == "":
             return "(anonymiseret)"
+        if self.header_from is None:
+            return self._decode_from()
+        return self.header_from
+
+    def _decode_from(self):
         return str(decode_any_header(self.parsed_headers.get('From') or ''))
 
     def from_address(self):
@@ -449,7 +984,15 @@ class Message(models.Model):
         returns the addresses joined with commas
         (or the empty string in case of no From:-header).
         '''
-        parsed = email.utils.getaddresses(self.parsed_headers.get_all('From'))
+        # header_from_address is truncated to 190 characters.
+        if (self.header_from_address is None or
+                len(self.header_from_address) >= 190):
+            return self._parse_from_address()
+        return self.header_from_address
+
+    def _parse_from_address(self):
+        parsed = email.utils.getaddresses(
+            self.parsed_headers.get_all('From') or ())
         return ','.join(address for realname, address in parsed)
 
     def outgoing_from(self):
@@ -465,6 +1008,14 @@ class Message(models.Model):
         return self.parsed_outgoing_headers.get_content_type()
 
     def to_people(self):
+        if self.header_to_people is None:
+            yield from self._parse_to_people()
+            return
+        # Scrubbed messages used to get "" rather than "[]".
+        for formatted, abbreviated in json.loads(self.header_to_people or "[]"):
+            yield formatted, abbreviated
+
+    def _parse_to_people(self):
         keys = ('To', 'Cc')
         values = [v for k in keys
                   for v in (self.parsed_headers.get_all(k) or ())]
@@ -495,7 +1046,20 @@ class Message(models.Model):
         hrefs = [h.strip().strip('<>') for h in header.split(',')]
         return html.format_html_join(', ', '<a href="{0}">{0}</a>', zip(hrefs))
 
+    def date(self):
+        if self.header_date is None:
+            return self._parse_date()
+        return self.header_date
+
+    def _parse_date(self):
+        return (self.parsed_headers.get('Date') or '').strip()
+
     def subject(self):
+        if self.header_subject is None:
+            return self._decode_subject()
+        return self.header_subject
+
+    def _decode_subject(self):
         return str(decode_any_header(self.parsed_headers.get('Subject') or ''))
 
     def get_absolute_url(self):
@@ -517,7 +1081,7 @@ class Message(models.Model):
         except Exception:
             return 'Failed to decode as %r' % (charset,)
         if text_part.get_content_subtype() == 'html':
-            payload = html_to_plain(payload)
+            payload = html_to_plain(payload, settings.HTML_TO_PLAIN_LIMIT)
         return payload
 
     @classmethod
@@ -531,9 +1095,23 @@ class Message(models.Model):
         self.filtered_by = filter
         self.status_on = timezone.now()
 
+    @classmethod
+    def set_status_many(cls, messages, status, *, user=None):
+        '''
+        Like set_status followed by save, for many messages in one UPDATE.
+        '''
+        if not messages:
+            return
+        cls.objects.filter(pk__in=[m.pk for m in messages]).update(
+            status=status, status_by=user, filtered_by=None,
+            status_on=timezone.now())
+
     def exists_earlier_identical_forwarded_message(self):
         if self.message_id is None:
             return False
+        return self.earlier_identical_forwarded_messages().exists()
+
+    def earlier_identical_forwarded_messages(self):
         qs = Message.objects.filter(
             message_id=self.message_id,
             created_time__lt=self.created_time,
@@ -546,16 +1124,14 @@ class Message(models.Model):
         qs = qs.filter(
             rcpt_tos=self.rcpt_tos,
         )
-        return qs.exists()
+        return qs
 
     def filter_incoming(self):
         '''
         Apply any applicable FilterRules to message.
         '''
-        filters = (FilterRule.objects.filter(peer=None) |
-                   FilterRule.objects.filter(peer=self.peer))
-        filters = filters.order_by('order')
-        filter = FilterRule.filter_message(filters, self)
+        with mailhole.metrics.filter_seconds.time():
+            filter = FilterRule.compiled_for_peer(self.peer).match(self)
         if filter is None:
             if not mailhole.policy.allow_automatic_forward(self):
                 return
@@ -568,11 +1144,13 @@ class Message(models.Model):
                     logger.info('message:%s has already been forwarded before => don\'t forward (mailbox)',
                                 self.pk)
                     return
-                SentMessage.create_and_send(self, user=None)
+                self.forward_automatically()
             return
         logger.info('message:%s from peer:%s:%s matches filter:%s => %s',
                     self.pk, self.peer_id, self.peer.slug,
                     filter.pk, filter.action)
+        mailhole.metrics.filter_rule_hits.inc(rule=filter.pk,
+                                              action=filter.action)
         if filter.action == FilterRule.MARK_SPAM:
             self.set_status(Message.SPAM, filter=filter)
             self.save()
@@ -585,10 +1163,22 @@ class Message(models.Model):
                 logger.info('message:%s has already been forwarded before => don\'t forward (filter)',
                             self.pk)
                 return
-            SentMessage.create_and_send(self, user=None)
+            self.forward_automatically()
         else:
             raise Exception(filter.action)
 
+    def forward_automatically(self):
+        '''
+        Forward message to its recipients, either right away or, if
+        settings.FORWARD_QUEUE is set, by the forward_queue command.
+        '''
+        if settings.FORWARD_QUEUE:
+            item = ForwardQueueItem.objects.create(message=self)
+            logger.info('message:%s queued as forwardqueueitem:%s',
+                        self.pk, item.pk)
+        else:
+            SentMessage.create_and_send(self, user=None)
+
     def recipients(self):
         return self.rcpt_tos.split(Message.RECIPIENT_SEP)
 
@@ -623,31 +1213,167 @@ class SentMessage(models.Model):
                                         self.message.subject())
 
     @classmethod
-    def create_and_send(cls, message, user, recipient=None):
+    def create_and_send(cls, message, user, recipient=None, recipients=None,
+                        connection=None):
+        '''
+        Forward message to recipient, or if None, to recipients,
+        or if None, to message.recipients().
+
+        To reuse one SMTP session for many messages, pass an email backend
+        from django.core.mail.get_connection() as connection; it is opened
+        when needed and the caller must close it.
+        '''
         try:
             mailhole.policy.rewrite_message(message)
         except Exception:
             logger.exception("Could not apply policy")
-        if recipient is None:
+        if recipient is not None:
+            recipients = [recipient]
+        elif recipients is None:
             recipients = message.recipients()
+        if connection is None:
+            connection = django.core.mail.get_connection()
+            close_connection = True
         else:
-            recipients = [recipient]
-        for r in recipients:
-            logger.info('user:%s (%s) message:%s forwarded to <%s>',
-                        user and user.pk, user and user.username,
-                        message.pk, r)
-            sent_message = SentMessage(message=message,
-                                       recipient=r,
-                                       created_by=user)
-            sent_message.clean()
-            email_backend = django.core.mail.get_connection()
-            from_email = mailhole.policy.override_outgoing_mail_from(message.mail_from)
-            email_message = UnsafeEmailMessage(message.message, r, from_email=from_email)
-            email_backend.send_messages([email_message])
-            sent_message.save()
+            close_connection = False
+        from_email = mailhole.policy.override_outgoing_mail_from(message.mail_from)
+        try:
+            if recipients:
+                with timer(SMTP):
+                    try:
+                        connection.open()
+                    except Exception:
+                        mailhole.metrics.smtp_failures.inc()
+                        raise
+            for r in recipients:
+                logger.info('user:%s (%s) message:%s forwarded to <%s>',
+                            user and user.pk, user and user.username,
+                            message.pk, r)
+                sent_message = SentMessage(message=message,
+                                           recipient=r,
+                                           created_by=user)
+                sent_message.clean()
+                email_message = UnsafeEmailMessage(message.outgoing_message, r,
+                                                   from_email=from_email)
+                with timer(SMTP), mailhole.metrics.smtp_send_seconds.time():
+                    try:
+                        connection.send_messages([email_message])
+                    except Exception:
+                        mailhole.metrics.smtp_failures.inc()
+                        raise
+                sent_message.save()
+                mailhole.metrics.forwards.inc(mailbox=message.mailbox.name)
+        finally:
+            if close_connection:
+                with timer(SMTP):
+                    connection.close()
         mailhole.policy.data_retention_after_send(message)
 
 
+class ForwardQueueItem(models.Model):
+    '''
+    A message waiting to be forwarded to its recipients by the
+    forward_queue management command (used if settings.FORWARD_QUEUE).
+    '''
+    message = models.ForeignKey(Message, on_delete=models.CASCADE)
+    created_time = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_time = models.DateTimeField(default=timezone.now,
+                                             db_index=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return '<ForwardQueueItem %s message:%s>' % (
+            self.created_time.isoformat(), self.message_id)
+
+    def remaining_recipients(self):
+        '''
+        Recipients that have not yet been sent the message since it was
+        queued, in case an earlier attempt failed halfway through.
+        '''
+        sent = set(SentMessage.objects.filter(
+            message_id=self.message_id,
+            created_time__gte=self.created_time,
+        ).values_list('recipient', flat=True))
+        return [r for r in self.message.recipients() if r not in sent]
+
+
+class BulkAction(models.Model):
+    '''
+    Marking all messages in a folder that match a filter as spam or trash,
+    done in batches by the bulk_actions management command.
+    '''
+    ACTION = [
+        (Message.SPAM, 'Markér som spam'),
+        (Message.TRASH, 'Slet'),
+    ]
+
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL,
+                                   null=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    mailboxes = models.ManyToManyField(Mailbox)
+    status = models.CharField(max_length=10, choices=Message.STATUS)
+    sender = models.CharField(max_length=190, blank=True,
+                              help_text='Blank betyder "alle afsendere"')
+    peer = models.ForeignKey(Peer, on_delete=models.CASCADE,
+                             blank=True, null=True,
+                             help_text='Blank betyder "alle servere"')
+    action = models.CharField(max_length=10, choices=ACTION)
+    # Number of matching messages when the action was created.
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+    # Messages are processed in pk order, so the action can be resumed.
+    last_pk = models.IntegerField(default=0)
+    finished_time = models.DateTimeField(blank=True, null=True,
+                                         db_index=True)
+
+    def __str__(self):
+        return '<BulkAction %s %s -> %s>' % (self.created_time.isoformat(),
+                                             self.status, self.action)
+
+    def get_queryset(self):
+        qs = Message.objects.filter(status=self.status,
+                                    mailbox__in=self.mailboxes.all())
+        if self.sender:
+            qs = qs.filter(header_from_address=self.sender)
+        if self.peer_id is not None:
+            qs = qs.filter(peer_id=self.peer_id)
+        return qs
+
+    def process_batch(self, batch_size):
+        '''
+        Apply the action to the next batch_size matching messages.
+        Sets finished_time when there are no more.
+        '''
+        qs = self.get_queryset().filter(pk__gt=self.last_pk).order_by('pk')
+        pks = list(qs.values_list('pk', flat=True)[:batch_size])
+        with transaction.atomic():
+            if pks:
+                # Filter by status again in case a message was changed
+                # since it was selected.
+                n = self.get_queryset().filter(pk__in=pks).update(
+                    status=self.action, status_by=self.created_by,
+                    filtered_by=None, status_on=timezone.now())
+                self.done += n
+                self.last_pk = pks[-1]
+                logger.info('bulk:%s user:%s marked %s messages %s ' +
+                            '(message:%s to message:%s)',
+                            self.pk, self.created_by_id, n, self.action,
+                            pks[0], pks[-1])
+            if len(pks) < batch_size:
+                self.finished_time = timezone.now()
+            self.save()
+        return len(pks)
+
+    def progress(self):
+        if not self.total:
+            return 100
+        return min(100, 100 * self.done // self.total)
+
+    def get_absolute_url(self):
+        return reverse('bulk_action_detail', kwargs=dict(pk=self.pk))
+
+
 class MonitorMessage(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     body = models.TextField()
@@ -22,9 +22,9 @@ def rewrite_message(message):
     from_address = rewrite_from(message)
     if from_address is not None:
         logger.info(
-            "Policy rewrite: From: %r -> %r", message.message["From"], from_address
+            "Policy rewrite: From: %r -> %r", message.outgoing_message["From"], from_address
         )
-        message.message.replace_header("From", from_address)
+        message.outgoing_message.replace_header("From", from_address)
 
 
 def allow_automatic_forward(message):
@@ -57,12 +57,15 @@ def data_retention_after_send(message) -> None:
         return
     if message.mailbox.data_retention != models.Mailbox.DELETE:
         return
+    # Files are shared by messages with identical content, so
+    # Message.delete_file only deletes them when no other message refers
+    # to them.
     try:
-        message.message_file.delete()
+        message.delete_file(message.message_file)
     except Exception:
         logger.exception("Could not delete message_file")
     try:
-        message.orig_message_file.delete()
+        message.delete_file(message.orig_message_file)
     except Exception:
         logger.exception("Could not delete orig_message_file")
     message.mail_from = "<mailhole_scrubbed>"
@@ -72,6 +75,7 @@ def data_retention_after_send(message) -> None:
     # message.orig_rcpt_tos = "<mailhole_scrubbed>"
     message.headers = ""
     message.outgoing_headers = ""
+    message.scrub_header_fields()
     # We don't scrub message_id
     # message.message_id = ""
     message.body_text_bytes = None
@@ -42,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it counts the queries of the other middleware too.
+    'mailhole.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -166,3 +168,25 @@ LOGGING = {
 
 NO_OUTGOING_EMAIL = False
 REQUIRE_FROM_REWRITING = False
+# If True, automatic forwards are queued and sent by
+# `./manage.py forward_queue` instead of during /api/submit/.
+FORWARD_QUEUE = False
+# If True, message lists have "newer"/"older" links instead of page numbers,
+# which stay fast on huge folders.
+KEYSET_PAGINATION = False
+# Only the first HTML_TO_PLAIN_LIMIT characters of an HTML body are
+# converted to the plain text shown on the message page, since html2text
+# is very slow on some huge HTML mails.
+HTML_TO_PLAIN_LIMIT = 256 * 1024
+# Reads both plain files and the packs written by ./manage.py pack_messages.
+DEFAULT_FILE_STORAGE = 'mailhole.storage.PackedFileSystemStorage'
+# If set, /metrics/ can be scraped with "Authorization: Bearer <token>"
+# (superusers can always see it).
+METRICS_TOKEN = None
+# Directory where each process writes its metrics, so that /metrics/ shows
+# the sum over all processes. If None, /metrics/ only shows the values of
+# the process that handles the request.
+METRICS_DIR = None
+# If True, every request is logged with its number of SQL queries and
+# timings (see mailhole.instrumentation).
+LOG_REQUEST_STATS = False
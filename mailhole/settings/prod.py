@@ -5,10 +5,12 @@ ADMINS = (
 )
 
 SECRET_KEY = os.environ['DJANGO_SECRET_KEY']
+METRICS_TOKEN = os.environ.get('MAILHOLE_METRICS_TOKEN')
 DEBUG = False
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'prodekanus/static')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'prodekanus/uploads')
+METRICS_DIR = os.path.join(BASE_DIR, 'prodekanus/metrics')
 
 ALLOWED_HOSTS = ['mail.tket.dk']
 
@@ -0,0 +1,146 @@
+import os
+import gzip
+import fcntl
+import struct
+import contextlib
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+
+from mailhole.instrumentation import timer, STORAGE
+
+
+PACK_DIR = 'messages/packs'
+PACK_SEP = ':'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+# Lock file in MEDIA_ROOT, see blob_lock().
+BLOB_LOCK = 'messages.lock'
+
+
+@contextlib.contextmanager
+def blob_lock(storage, exclusive):
+    '''
+    Lock that makes Message.store_blob reusing a blob (shared) atomic with
+    respect to checking and deleting an unreferenced blob (exclusive).
+    '''
+    path = storage.path(BLOB_LOCK)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def packed_name(pack, offset, length):
+    return '%s%s%d%s%d' % (pack, PACK_SEP, offset, PACK_SEP, length)
+
+
+def split_packed_name(name):
+    '''
+    Return (pack, offset, length) if name refers to a file inside a pack
+    written by ./manage.py pack_messages, or None otherwise.
+    '''
+    if not name.startswith(PACK_DIR + '/') or name.count(PACK_SEP) != 2:
+        return None
+    pack, offset, length = name.split(PACK_SEP)
+    return pack, int(offset), int(length)
+
+
+class PackedFileSystemStorage(FileSystemStorage):
+    '''
+    FileSystemStorage that can also read files from the packs written by
+    ./manage.py pack_messages.
+
+    A pack is a concatenation of gzip members, one for each file, and a
+    file in a pack is named "<pack>:<offset>:<length>" after the position
+    of its gzip member in the pack.
+
+    Files in packs are read-only. Deleting one overwrites its gzip member
+    with zeros, so the content is gone even though the pack is only
+    deleted by ./manage.py purge_messages --orphans when no message refers
+    to any of its files.
+
+    The time spent in the storage is counted by
+    mailhole.instrumentation.InstrumentationMiddleware.
+    '''
+
+    def _read_packed(self, pack, offset, length):
+        with super()._open(pack, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(length)
+        if len(data) != length:
+            raise IOError('Truncated pack %r' % (pack,))
+        return data
+
+    def _open(self, name, mode='rb'):
+        packed = split_packed_name(name)
+        if packed is not None and mode != 'rb':
+            raise ValueError('Files in packs can only be opened in mode rb')
+        with timer(STORAGE):
+            if packed is None:
+                return super()._open(name, mode)
+            return ContentFile(gzip.decompress(self._read_packed(*packed)),
+                               name=name)
+
+    def _save(self, name, content):
+        with timer(STORAGE):
+            return super()._save(name, content)
+
+    def exists(self, name):
+        packed = split_packed_name(name)
+        with timer(STORAGE):
+            if packed is None:
+                return super().exists(name)
+            pack, offset, length = packed
+            if not super().exists(pack):
+                return False
+            # A deleted file is overwritten with zeros.
+            return self._read_packed(pack, offset, 2) == GZIP_MAGIC
+
+    def size(self, name):
+        packed = split_packed_name(name)
+        with timer(STORAGE):
+            if packed is None:
+                return super().size(name)
+            pack, offset, length = packed
+            # The gzip trailer ends with the uncompressed size modulo 2**32.
+            trailer = self._read_packed(pack, offset + length - 4, 4)
+            return struct.unpack('<I', trailer)[0]
+
+    def delete(self, name):
+        packed = split_packed_name(name)
+        with timer(STORAGE):
+            if packed is None:
+                super().delete(name)
+            else:
+                self._erase_packed(*packed)
+
+    def _erase_packed(self, pack, offset, length):
+        try:
+            fp = open(self.path(pack), 'r+b')
+        except FileNotFoundError:
+            return
+        with fp:
+            if os.fstat(fp.fileno()).st_size < offset + length:
+                raise IOError('Truncated pack %r' % (pack,))
+            fp.seek(offset)
+            while length > 0:
+                n = min(length, 2**16)
+                fp.write(bytes(n))
+                length -= n
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def get_accessed_time(self, name):
+        return super().get_accessed_time(self._file_name(name))
+
+    def get_created_time(self, name):
+        return super().get_created_time(self._file_name(name))
+
+    def get_modified_time(self, name):
+        return super().get_modified_time(self._file_name(name))
+
+    def _file_name(self, name):
+        packed = split_packed_name(name)
+        return name if packed is None else packed[0]
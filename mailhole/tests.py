@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase
+
+from mailhole.models import FilterRule, CompiledFilterRules
+
+
+class CompiledFilterRulesTest(SimpleTestCase):
+    def rule(self, order, pattern):
+        return FilterRule(order=order, kind=FilterRule.HEADER_MATCH,
+                          pattern=pattern, action=FilterRule.MARK_SPAM)
+
+    def message(self, **headers):
+        return SimpleNamespace(orig_mail_from='a@example.com',
+                               parsed_headers=headers)
+
+    def test_exact_headers_with_same_casefold(self):
+        # "ß" casefolds to "ss", but re.I does not match it with "SS",
+        # so both rules share a key in the exact header dict.
+        filters = [self.rule(0, r'^From: Straße$'),
+                   self.rule(1, r'^From: STRASSE$')]
+        compiled = CompiledFilterRules(filters)
+        for value in ('strasse', 'Straße', 'other'):
+            message = self.message(From=value)
+            self.assertIs(compiled.match(message),
+                          FilterRule.filter_message(filters, message), value)
+        self.assertIs(compiled.match(self.message(From='strasse')),
+                      filters[1])
@@ -25,14 +25,26 @@ urlpatterns = [
 
     url(r'^$', mailhole.views.MailboxList.as_view(), name='mailbox_list'),
     url(r'^log/$', mailhole.views.Log.as_view(), name='log'),
+    url(r'^log/requests/$', mailhole.views.RequestStats.as_view(),
+        name='request_stats'),
+    url(r'^metrics/$', mailhole.views.Metrics.as_view(), name='metrics'),
     url(r'^login/$', mailhole.views.LoginView.as_view(), name='login'),
     url(r'^api/submit/$', mailhole.views.Submit.as_view(), name='submit'),
+    url(r'^api/submit/batch/$', mailhole.views.SubmitBatch.as_view(),
+        name='submit_batch'),
+    url(r'^bulk/(?P<pk>\d+)/$', mailhole.views.BulkActionDetail.as_view(),
+        name='bulk_action_detail'),
     url(r'^(?P<mailbox>[^/]+)/$',
         mailhole.views.MailboxDetail.as_view(), name='mailbox_detail'),
     url(r'^all/(?P<status>inbox|spam|trash)/$',
         mailhole.views.MessageList.as_view(), name='message_list'),
+    url(r'^all/(?P<status>inbox|spam|trash)/bulk/$',
+        mailhole.views.BulkActionCreate.as_view(), name='bulk_action_create'),
     url(r'^(?P<mailbox>[^/]+)/(?P<status>inbox|spam|trash)/$',
         mailhole.views.MailboxMessageList.as_view(), name='mailbox_message_list'),
+    url(r'^(?P<mailbox>[^/]+)/(?P<status>inbox|spam|trash)/bulk/$',
+        mailhole.views.MailboxBulkActionCreate.as_view(),
+        name='mailbox_bulk_action_create'),
     url(r'^(?P<mailbox>[^/]+)/(?P<pk>\d+)/$',
         mailhole.views.MessageDetail.as_view(), name='message_detail'),
     url(r'^(?P<mailbox>[^/]+)/defaction/$',
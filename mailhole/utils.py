@@ -1,21 +1,73 @@
-from unittest.mock import patch
+import functools
 import html2text
 import email.header
 import email.errors
 
 
-def html_to_plain(body):
+class PlainTextConverter(html2text.HTML2Text):
+    '''
+    html2text configured to produce plain text instead of Markdown.
+
+    A converter can only be used for a single document.
+    '''
+
+    def __init__(self):
+        super().__init__(bodywidth=0)
+        self.ignore_links = True
+        self.unicode_snob = True
+        self.images_to_alt = True
+
+    def handle_data(self, data, entity_char=False):
+        # With entity_char=True, html2text does not backslash-escape
+        # Markdown syntax in the text.
+        super().handle_data(data, entity_char=True)
+
+
+def html_to_plain(body, limit=None):
+    '''
+    Convert HTML to plain text. If body is longer than limit characters,
+    only the beginning is converted and the text ends with "[...]".
+    '''
     # From regnskab.utils
-    h = html2text.HTML2Text()
-    h.ignore_links = True
-    h.unicode_snob = True
-    h.images_to_alt = True
-    h.body_width = 0
-    with patch('html2text.escape_md_section', (lambda t, snob=False: t)):
-        return h.handle(str(body))
+    body = str(body)
+    truncated = limit is not None and len(body) > limit
+    if truncated:
+        # Cut after the end of a tag, so the text of the last element
+        # is not cut in the middle of a word.
+        body = body[:body.rfind('>', 0, limit) + 1 or limit]
+    text = PlainTextConverter().handle(body)
+    if truncated:
+        text += '\n[...]\n'
+    return text
+
+
+# Number of distinct header values whose decoding is cached.
+DECODE_HEADER_CACHE_SIZE = 4096
 
 
 def decode_any_header(value):
+    '''
+    Decode an RFC 2047 header value to str, absorbing all errors.
+
+    Header values repeat a lot (e.g. From of mailing lists), so str values
+    are cached; decode_any_header.cache_info() reports hits and misses.
+    '''
+    if isinstance(value, str):
+        return _decode_any_header_cached(value)
+    # E.g. an email.header.Header, which is not hashable.
+    return str(_decode_any_header(value))
+
+
+@functools.lru_cache(maxsize=DECODE_HEADER_CACHE_SIZE)
+def _decode_any_header_cached(value):
+    return str(_decode_any_header(value))
+
+
+decode_any_header.cache_info = _decode_any_header_cached.cache_info
+decode_any_header.cache_clear = _decode_any_header_cached.cache_clear
+
+
+def _decode_any_header(value):
     '''Wrapper around email.header.decode_header to absorb all errors.'''
     # From emailtunnel
     try:
@@ -1,12 +1,18 @@
+import hmac
+import json
 import logging
+import datetime
 
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, InvalidPage
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.utils.decorators import method_decorator
 from django.http import (
-    HttpResponseBadRequest, HttpResponse, HttpResponseNotFound,
+    HttpResponseBadRequest, HttpResponse, HttpResponseNotFound, JsonResponse,
+    HttpResponseForbidden,
 )
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import (
@@ -17,11 +23,14 @@ from django.contrib.auth import views as auth_views
 from django.contrib.auth.mixins import AccessMixin
 
 from mailhole.models import (
-    Mailbox, Message, SentMessage,
+    Mailbox, Message, SentMessage, BulkAction,
 )
 from mailhole.forms import (
-    AuthenticationForm, SubmitForm, MessageListForm, MessageDetailForm,
+    AuthenticationForm, SubmitForm, BatchSubmitForm, MessageListForm,
+    MessageDetailForm, BulkActionForm,
 )
+import mailhole.instrumentation
+import mailhole.metrics
 
 
 logger = logging.getLogger('mailhole')
@@ -70,10 +79,11 @@ class MailboxList(MailboxRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
         context_data['object_list'] = self.mailboxes
+        Mailbox.count_folders(self.mailboxes)
         context_data['all_folders'] = [
             (key, label, reverse('message_list', kwargs=dict(status=key)),
-             Message.objects.filter(mailbox__in=self.mailboxes,
-                                    status=key))
+             sum(mailbox.folder_counts.get(key, 0)
+                 for mailbox in self.mailboxes))
             for key, label in Message.STATUS
         ]
         return context_data
@@ -88,23 +98,106 @@ class MailboxDetail(SingleMailboxRequiredMixin, TemplateView):
         return context_data
 
 
+class KeysetPage:
+    '''
+    A page of messages ordered by descending (created_time, pk).
+
+    Unlike a Paginator page it is located by a cursor, the (created_time, pk)
+    of the message just before it, so it costs the same at any depth and
+    needs no COUNT(*).
+    '''
+    EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    # Cursors are limited to what the database can compare with: DATETIME
+    # in MySQL ends in year 9999, and AutoField is a signed 32-bit integer.
+    MAX_TIME = datetime.datetime(9999, 1, 1, tzinfo=datetime.timezone.utc)
+    MAX_PK = 2**31 - 1
+
+    def __init__(self, queryset, per_page, after=None, before=None):
+        if before is not None:
+            t, pk = self.decode_cursor(before)
+            qs = queryset.filter(Q(created_time__gt=t) |
+                                 Q(created_time=t, pk__gt=pk))
+            qs = qs.order_by('created_time', 'pk')
+        else:
+            qs = queryset
+            if after is not None:
+                t, pk = self.decode_cursor(after)
+                qs = qs.filter(Q(created_time__lt=t) |
+                               Q(created_time=t, pk__lt=pk))
+            qs = qs.order_by('-created_time', '-pk')
+        # Fetch one extra message to see if there are more.
+        object_list = list(qs[:per_page + 1])
+        more = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        if before is not None:
+            object_list.reverse()
+            has_next, has_previous = True, more
+        else:
+            has_next, has_previous = more, after is not None
+        self.object_list = object_list
+        self.next_cursor = self.previous_cursor = None
+        if object_list and has_next:
+            self.next_cursor = self.encode_cursor(object_list[-1])
+        if object_list and has_previous:
+            self.previous_cursor = self.encode_cursor(object_list[0])
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @classmethod
+    def encode_cursor(cls, message):
+        microseconds = ((message.created_time - cls.EPOCH) //
+                        datetime.timedelta(microseconds=1))
+        return '%s_%s' % (microseconds, message.pk)
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        '''
+        Raises ValueError if cursor is invalid.
+        '''
+        microseconds, pk = cursor.split('_')
+        microseconds, pk = int(microseconds), int(pk)
+        if not 0 < pk <= cls.MAX_PK:
+            raise ValueError('Cursor pk out of range')
+        try:
+            t = cls.EPOCH + datetime.timedelta(microseconds=microseconds)
+        except OverflowError:
+            raise ValueError('Cursor time out of range')
+        if not cls.EPOCH <= t < cls.MAX_TIME:
+            raise ValueError('Cursor time out of range')
+        return t, pk
+
+
 class MessageListBase(FormView):
     template_name = 'mailhole/message_list.html'
     form_class = MessageListForm
+    paginate_by = 100
 
     def get_queryset(self):
         raise NotImplementedError
 
+    def get_list_queryset(self):
+        qs = self.get_queryset()
+        # Each row shows its mailbox, but never the body.
+        qs = qs.select_related('mailbox', 'peer')
+        qs = qs.defer('body_text_bytes')
+        return qs
+
     def get_paginator(self):
         try:
             return self._paginator
         except AttributeError:
-            qs = self.get_queryset()
+            qs = self.get_list_queryset()
             qs = qs.order_by('-created_time')
-            self._paginator = Paginator(qs, 100)
+            self._paginator = Paginator(qs, self.paginate_by)
             return self._paginator
 
     def get_page(self):
+        if settings.KEYSET_PAGINATION:
+            return self.get_keyset_page()
         paginator = self.get_paginator()
         page = self.request.GET.get('p')
         try:
@@ -112,6 +205,21 @@ class MessageListBase(FormView):
         except InvalidPage:
             return paginator.page(1)
 
+    def get_keyset_page(self):
+        try:
+            return self._keyset_page
+        except AttributeError:
+            pass
+        qs = self.get_list_queryset()
+        try:
+            self._keyset_page = KeysetPage(
+                qs, self.paginate_by,
+                after=self.request.GET.get('after'),
+                before=self.request.GET.get('before'))
+        except (ValueError, OverflowError):
+            self._keyset_page = KeysetPage(qs, self.paginate_by)
+        return self._keyset_page
+
     def get_form_kwargs(self, **kwargs):
         kwargs = super().get_form_kwargs(**kwargs)
         kwargs['queryset'] = self.get_page()
@@ -125,12 +233,18 @@ class MessageListBase(FormView):
         context_data['inbox'] = self.kwargs['status'] == Message.INBOX
         context_data['object_list'] = form.messages
         context_data['page'] = self.get_page()
-        context_data['paginator'] = self.get_paginator()
+        if settings.KEYSET_PAGINATION:
+            context_data['keyset'] = True
+        else:
+            context_data['paginator'] = self.get_paginator()
         return context_data
 
     def form_valid(self, form):
         # form.save logs the action(s)
         form.save(self.request.user)
+        if settings.KEYSET_PAGINATION:
+            # The cursor is still valid after the action.
+            return redirect(self.request.get_full_path())
         return redirect(self.request.path)
 
 
@@ -155,6 +269,72 @@ class MailboxMessageList(SingleMailboxRequiredMixin, MessageListBase):
         return context_data
 
 
+class BulkActionCreateBase(FormView):
+    template_name = 'mailhole/bulk_action_form.html'
+    form_class = BulkActionForm
+
+    def get_mailboxes(self):
+        raise NotImplementedError
+
+    def get_initial(self):
+        return dict(sender=self.request.GET.get('sender', ''))
+
+    def get_form_kwargs(self, **kwargs):
+        kwargs = super().get_form_kwargs(**kwargs)
+        kwargs['status'] = self.kwargs['status']
+        kwargs['mailboxes'] = self.get_mailboxes()
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['status'] = Message.status_display(self.kwargs['status'])
+        return context_data
+
+    def form_valid(self, form):
+        # form.save logs the action
+        bulk_action = form.save(self.request.user)
+        return redirect(bulk_action)
+
+
+class BulkActionCreate(MailboxRequiredMixin, BulkActionCreateBase):
+    def get_mailboxes(self):
+        return self.mailboxes
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['all'] = True
+        return context_data
+
+
+class MailboxBulkActionCreate(SingleMailboxRequiredMixin,
+                              BulkActionCreateBase):
+    def get_mailboxes(self):
+        return [self.mailbox]
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['mailbox'] = self.mailbox
+        return context_data
+
+
+class BulkActionDetail(AccessMixin, TemplateView):
+    template_name = 'mailhole/bulk_action_detail.html'
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return self.handle_no_permission()
+        qs = BulkAction.objects.all()
+        if not request.user.is_superuser:
+            qs = qs.filter(created_by=request.user)
+        self.bulk_action = get_object_or_404(qs, pk=kwargs['pk'])
+        return super().dispatch(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['bulk_action'] = self.bulk_action
+        return context_data
+
+
 class MessageDetail(SingleMailboxRequiredMixin, FormView):
     form_class = MessageDetailForm
     template_name = 'mailhole/message_detail.html'
@@ -240,6 +420,59 @@ class Submit(FormView):
         return HttpResponse('250 OK')
 
 
+class SubmitBatch(Submit):
+    '''
+    Like Submit, but for many messages in one request.
+
+    All messages are stored in one transaction. The response is a JSON
+    object whose "results" list has one entry per envelope, either
+    {"status": "250 OK", "messages": [pk, ...]},
+    {"status": "400 Bad Request", "errors": {...}} or, if storing it failed
+    for another reason (which is logged), {"status": "451 Temporary failure"}
+    so the peer can submit that envelope again later.
+    '''
+    form_class = BatchSubmitForm
+
+    def form_valid(self, form):
+        peer = form.cleaned_data['peer']
+        results = []
+        stored = []
+        with transaction.atomic():
+            for i, envelope_form in enumerate(form.envelope_forms()):
+                if envelope_form.is_valid():
+                    try:
+                        # A failing message must not roll back the others.
+                        with transaction.atomic():
+                            # envelope_form.save() logs the action
+                            messages = envelope_form.save(peer)
+                    except ValidationError as exn:
+                        envelope_form.add_error(None, exn)
+                    except Exception:
+                        logger.exception('SubmitBatch.form_valid(): ' +
+                                         'envelope %s failed', i)
+                        results.append({'status': '451 Temporary failure'})
+                        continue
+                if envelope_form.errors:
+                    json_errors = envelope_form.errors.as_json()
+                    logger.warning('SubmitBatch.form_valid(): envelope %s: %s',
+                                   i, json_errors)
+                    results.append({'status': '400 Bad Request',
+                                    'errors': json.loads(json_errors)})
+                    continue
+                stored.extend(messages)
+                results.append({'status': '250 OK',
+                                'messages': [m.pk for m in messages]})
+        # Filter after commit so that forwarding does not hold the transaction.
+        for message in stored:
+            try:
+                message.filter_incoming()
+            except Exception:
+                # The message stays in the inbox.
+                logger.exception('message:%s filter_incoming failed',
+                                 message.pk)
+        return JsonResponse({'results': results})
+
+
 class Log(SuperuserRequiredMixin, View):
     def get(self, request):
         filename = settings.LOGGING['handlers']['file']['filename']
@@ -248,6 +481,48 @@ class Log(SuperuserRequiredMixin, View):
         return HttpResponse(s, content_type='text/plain; charset=utf8')
 
 
+class RequestStats(SuperuserRequiredMixin, TemplateView):
+    '''
+    Queries and time per view, as measured by InstrumentationMiddleware
+    in the process that handles this request.
+    '''
+    template_name = 'mailhole/request_stats.html'
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['buckets'] = [
+            '> %s' % mailhole.instrumentation.BUCKETS[-2] if bound is None
+            else '≤ %s' % bound
+            for bound in mailhole.instrumentation.BUCKETS]
+        context_data['views'] = mailhole.instrumentation.view_stats()
+        context_data['log_request_stats'] = settings.LOG_REQUEST_STATS
+        return context_data
+
+    def post(self, request):
+        mailhole.instrumentation.reset_stats()
+        return redirect('request_stats')
+
+
+class Metrics(View):
+    '''
+    The counters of mailhole.metrics in the Prometheus text format, for
+    superusers or for requests with the header
+    "Authorization: Bearer <settings.METRICS_TOKEN>".
+    '''
+    def get(self, request):
+        if not (request.user.is_superuser or self.valid_token(request)):
+            return HttpResponseForbidden()
+        return HttpResponse(mailhole.metrics.render(),
+                            content_type='text/plain; version=0.0.4')
+
+    def valid_token(self, request):
+        if not settings.METRICS_TOKEN:
+            return False
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        expected = 'Bearer %s' % settings.METRICS_TOKEN
+        return hmac.compare_digest(authorization.encode(), expected.encode())
+
+
 class DefaultActionUpdate(SingleMailboxRequiredMixin, UpdateView):
     template_name = 'mailhole/default_action_update.html'
     model = Mailbox
@@ -30,7 +30,7 @@ def make_monitor_message(to, messages):
         message_format.format(sender=message.from_(),
                               recipients=message.to_as_text(),
                               subject=message.subject(),
-                              date=message.parsed_headers.get('Date'))
+                              date=message.date())
         for message in messages)
 
     body = textwrap.dedent("""
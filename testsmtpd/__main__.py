@@ -1,11 +1,110 @@
-import io
-import aiohttp
+import os
+import json
+import time
+import uuid
+import asyncio
+import smtplib
 import argparse
-import requests
+import threading
+import concurrent.futures
+import email.utils
+import aiohttp
 import aiosmtpd.controller
 
 
+OK = '250 OK'
+TEMPFAIL = '451 4.3.0 Temporary failure, try again later'
+REJECTED = '554 5.6.0 Message rejected'
+
+# While /api/submit/ fails, retry the spool after 5 seconds, 10 seconds,
+# 20 seconds, ..., at most every 10 minutes.
+BACKOFF_BASE = 5
+BACKOFF_MAX = 600
+
+
+class Spool:
+    '''
+    Messages accepted over SMTP that could not be submitted yet, one file
+    per envelope: a line of JSON with mail_from and rcpt_tos, followed by
+    the message. A file is fsync'd before the message is accepted.
+    Messages rejected by /api/submit/ are moved to the subdirectory
+    "rejected", and messages that could not be submitted for too long to
+    the subdirectory "failed".
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.rejected_directory = os.path.join(directory, 'rejected')
+        self.failed_directory = os.path.join(directory, 'failed')
+        os.makedirs(self.rejected_directory, exist_ok=True)
+        os.makedirs(self.failed_directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.tmp'):
+                # Left by a crash before the message was accepted.
+                os.remove(os.path.join(directory, name))
+
+    def write(self, mail_from, rcpt_tos, content):
+        name = '%.6f-%s.msg' % (time.time(), uuid.uuid4().hex)
+        path = os.path.join(self.directory, name)
+        with open(path + '.tmp', 'xb') as fp:
+            envelope = dict(mail_from=mail_from, rcpt_tos=rcpt_tos)
+            fp.write(json.dumps(envelope).encode() + b'\n')
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(path + '.tmp', path)
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return name
+
+    def names(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.msg'))
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name), 'rb') as fp:
+            envelope = json.loads(fp.readline().decode())
+            content = fp.read()
+        return envelope['mail_from'], envelope['rcpt_tos'], content
+
+    def age(self, name):
+        '''
+        Seconds since the message was spooled, from the time in its name.
+        '''
+        return time.time() - float(name.split('-', 1)[0])
+
+    def remove(self, name):
+        os.remove(os.path.join(self.directory, name))
+
+    def reject(self, name):
+        os.rename(os.path.join(self.directory, name),
+                  os.path.join(self.rejected_directory, name))
+
+    def fail(self, name):
+        os.rename(os.path.join(self.directory, name),
+                  os.path.join(self.failed_directory, name))
+
+
 class Handler:
+    '''
+    Submits each message received over SMTP to /api/submit/.
+
+    All submissions share one aiohttp session, whose connections are kept
+    alive, and at most args.concurrency are in flight. When
+    args.max_pending messages are already waiting, new messages are
+    rejected with a temporary failure, so the sending MTA retries later.
+
+    With args.spool, a message that can't be submitted because of a
+    temporary failure is accepted into the Spool, and drain_spool submits
+    it later. While submissions fail, drain_spool tries one spooled message
+    at a time with exponential backoff; as soon as a submission succeeds,
+    the spool is drained in parallel. Spooled messages that are older than
+    args.spool_max_age hours are given up on and moved to "failed".
+    '''
+
     def __init__(self, args):
         try:
             int(args.http_port)
@@ -14,47 +113,265 @@ class Handler:
         else:
             self.url = 'http://127.0.0.1:%s/api/submit/' % args.http_port
         self.key = args.key
+        self.concurrency = args.concurrency
+        self.max_pending = args.max_pending
+        self.timeout = args.timeout
+        self.pending = 0
+        self.spool = Spool(args.spool) if args.spool else None
+        self.spool_max_age = args.spool_max_age * 3600
+        # Number of failed rounds of submissions since the last success,
+        # and the monotonic time of the next round of drain_spool.
+        self.failures = 0
+        self.retry_time = 0
+        # Spool file name -> failed attempts
+        self.attempts = {}
+        # Created in the event loop of the SMTP server.
+        self.http_session = None
+        self.semaphore = None
+        self.spool_event = None
+
+    def get_http_session(self):
+        if self.http_session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self.http_session
+
+    async def close(self):
+        if self.http_session is not None:
+            await self.http_session.close()
 
     async def handle_DATA(self, server, session, envelope):
-        # async with aiohttp.ClientSession(loop=server.loop) as session:
-        with requests.Session() as session:
-            for rcpt in envelope.rcpt_tos:
+        if self.pending >= self.max_pending:
+            print("From %r to %r... too busy" %
+                  (envelope.mail_from, envelope.rcpt_tos))
+            return '451 4.3.2 Too busy, try again later'
+        self.pending += 1
+        try:
+            reply = await self.submit(envelope.mail_from, envelope.rcpt_tos,
+                                      envelope.content)
+            if reply == TEMPFAIL and time.monotonic() >= self.retry_time:
+                # Back off as if drain_spool had failed, so it probes with
+                # one message instead of draining the spool in parallel.
+                self.backoff()
+            if reply == TEMPFAIL and self.spool is not None:
+                loop = asyncio.get_event_loop()
+                name = await loop.run_in_executor(
+                    None, self.spool.write, envelope.mail_from,
+                    envelope.rcpt_tos, envelope.content)
+                print("From %r to %r... spooled as %s" %
+                      (envelope.mail_from, envelope.rcpt_tos, name))
+                return OK
+            return reply
+        finally:
+            self.pending -= 1
+
+    async def submit(self, mail_from, rcpt_tos, content):
+        http_session = self.get_http_session()
+        async with self.semaphore:
+            reply = await self.post(http_session, mail_from, rcpt_tos,
+                                    content)
+        if reply != TEMPFAIL and self.failures:
+            # The backend is up, so drain the spool now.
+            self.failures = 0
+            self.retry_time = 0
+            if self.spool_event is not None:
+                self.spool_event.set()
+        return reply
+
+    def backoff(self):
+        self.failures += 1
+        self.retry_time = time.monotonic() + min(
+            BACKOFF_BASE * 2 ** (self.failures - 1), BACKOFF_MAX)
+
+    async def post(self, http_session, mail_from, rcpt_tos, content):
+        print("From %r to %r..." % (mail_from, rcpt_tos), end='')
+        try:
+            rcpt_tos = json.dumps(rcpt_tos)
+            data = aiohttp.FormData()
+            data.add_field('key', self.key)
+            data.add_field('mail_from', mail_from)
+            data.add_field('rcpt_tos', rcpt_tos)
+            data.add_field('orig_mail_from', mail_from)
+            data.add_field('orig_rcpt_tos', rcpt_tos)
+            for k in ('message_bytes', 'orig_message_bytes'):
+                data.add_field(k, content, filename='message.msg',
+                               content_type='message/rfc822')
+            try:
+                async with http_session.post(self.url, data=data) as response:
+                    text = await response.text()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exn:
+                print(' %s' % (exn.__class__.__name__,), end='')
+                return TEMPFAIL
+            if status == 200 and text.strip() == '250 OK':
+                print(' OK', end='')
+                return OK
+            print(' HTTP %s %r' % (status, text.splitlines()[0][:200]
+                                   if text else ''), end='')
+            if status == 400:
+                # The message was rejected by SubmitForm.
+                return REJECTED
+            return TEMPFAIL
+        finally:
+            print('')
+
+    async def drain_spool(self):
+        '''
+        Submit the spooled messages, at most 4 * args.concurrency at a time.
+        Runs until cancelled.
+        '''
+        loop = asyncio.get_event_loop()
+        self.spool_event = asyncio.Event()
+        while True:
+            self.spool_event.clear()
+            delay = self.retry_time - time.monotonic()
+            names = []
+            if delay <= 0:
+                names = await loop.run_in_executor(None, self.spool.names)
+            expired = [name for name in names
+                       if self.spool.age(name) > self.spool_max_age]
+            for name in expired:
+                print('Spooled %s not submitted within %s hours, giving up' %
+                      (name, self.spool_max_age / 3600))
+                await loop.run_in_executor(None, self.spool.fail, name)
+                self.attempts.pop(name, None)
+                names.remove(name)
+            if not names:
                 try:
-                    print("From %r to %r..." % (envelope.mail_from, rcpt), end='')
-                    data = dict(
-                        key=self.key,
-                        mail_from=envelope.mail_from,
-                        rcpt_to=rcpt,
-                    )
-                    files = dict(
-                        message_bytes=('message.msg', io.BytesIO(envelope.content)),
-                    )
-                    response = session.post(self.url, data=data, files=files)
-                    text = response.text
-                    status = response.status_code
-                    # async with session.post(self.url, data=data) as response:
-                    #     text = await response.text()
-                    #     status = response.status
-                    if status != 200 or text.strip() != '250 OK':
-                        print(' HTTP %s %r' %
-                              (status, text.splitlines()[0][:200]), end='')
-                        return '500 Internal server error'
-                    print(' OK', end='')
-                finally:
-                    print('')
-        return '250 OK'
+                    await asyncio.wait_for(self.spool_event.wait(),
+                                           max(0, min(delay, 1)) or 1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if self.failures:
+                # Probe with the message that has been tried the least,
+                # so one message that always fails can't block the rest.
+                names = [min(names, key=lambda n: self.attempts.get(n, 0))]
+            replies = await asyncio.gather(*[
+                self.deliver_spooled(name)
+                for name in names[:4 * self.concurrency]])
+            if TEMPFAIL in replies:
+                self.backoff()
+
+    async def deliver_spooled(self, name):
+        loop = asyncio.get_event_loop()
+        mail_from, rcpt_tos, content = await loop.run_in_executor(
+            None, self.spool.read, name)
+        reply = await self.submit(mail_from, rcpt_tos, content)
+        if reply == OK:
+            await loop.run_in_executor(None, self.spool.remove, name)
+            self.attempts.pop(name, None)
+        elif reply == REJECTED:
+            print('Spooled %s rejected' % name)
+            await loop.run_in_executor(None, self.spool.reject, name)
+            self.attempts.pop(name, None)
+        else:
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+        return reply
+
+
+def generate_load(args):
+    '''
+    Send args.load messages of args.load_size bytes to the SMTP server on
+    args.smtp_port over args.concurrency connections and report the
+    sustained rate.
+    '''
+    body = ('x' * 76 + '\r\n') * max(1, args.load_size // 78)
+    lock = threading.Lock()
+    counter = iter(range(args.load))
+    results = dict(ok=0, temp=0, perm=0)
+    latencies = []
+
+    def worker():
+        with smtplib.SMTP(args.smtp_host, args.smtp_port) as smtp:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                message = ('From: load@example.com\r\n' +
+                           'To: load@%s\r\n' % args.load_domain +
+                           'Subject: Load test %s\r\n' % i +
+                           'Message-ID: %s\r\n' % email.utils.make_msgid() +
+                           '\r\n' + body)
+                t = time.perf_counter()
+                try:
+                    smtp.sendmail('load@example.com',
+                                  ['load@%s' % args.load_domain], message)
+                    kind = 'ok'
+                except smtplib.SMTPResponseException as exn:
+                    kind = 'temp' if 400 <= exn.smtp_code < 500 else 'perm'
+                except smtplib.SMTPRecipientsRefused:
+                    kind = 'perm'
+                with lock:
+                    results[kind] += 1
+                    latencies.append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        for future in [executor.submit(worker)
+                       for _ in range(args.concurrency)]:
+            future.result()
+    duration = time.perf_counter() - t
+    latencies.sort()
+    print('%s messages in %.1f s: %.1f messages/s' %
+          (args.load, duration, args.load / duration))
+    print('accepted %(ok)s, temporary failures %(temp)s, ' % results +
+          'rejected %(perm)s' % results)
+    if latencies:
+        print('latency p50 %.0f ms, p99 %.0f ms, max %.0f ms' % (
+            1000 * latencies[len(latencies) // 2],
+            1000 * latencies[int(len(latencies) * 0.99)],
+            1000 * latencies[-1]))
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-P', '--smtp-port', type=int, default=1025)
+    parser.add_argument('--smtp-host', default='localhost')
     parser.add_argument('-p', '--http-port', default=8000)
-    parser.add_argument('-k', '--key', required=True)
+    parser.add_argument('-k', '--key')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='Simultaneous HTTP submissions (or SMTP ' +
+                             'connections with --load)')
+    parser.add_argument('--max-pending', type=int, default=100,
+                        help='Temporarily reject messages when this many ' +
+                             'are waiting to be submitted')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='Seconds to wait for /api/submit/')
+    parser.add_argument('--spool', metavar='DIR',
+                        help='Accept messages into DIR when /api/submit/ ' +
+                             'is unavailable and submit them later')
+    parser.add_argument('--spool-max-age', type=float, default=120,
+                        metavar='HOURS',
+                        help='Move spooled messages that could not be ' +
+                             'submitted within HOURS to DIR/failed')
+    parser.add_argument('--load', type=int, metavar='N',
+                        help='Instead of running a server, send N ' +
+                             'messages to the SMTP server on --smtp-host ' +
+                             'and --smtp-port')
+    parser.add_argument('--load-size', type=int, default=4000,
+                        help='Approximate size of each message in bytes')
+    parser.add_argument('--load-domain', default='example.com')
     args = parser.parse_args()
 
-    controller = aiosmtpd.controller.Controller(Handler(args),
+    if args.load is not None:
+        generate_load(args)
+        return
+    if not args.key:
+        parser.error('--key is required')
+
+    handler = Handler(args)
+    controller = aiosmtpd.controller.Controller(handler,
+                                                hostname=args.smtp_host,
                                                 port=args.smtp_port)
     controller.start()
+    if handler.spool is not None:
+        drain = asyncio.run_coroutine_threadsafe(handler.drain_spool(),
+                                                 controller.loop)
     try:
         input('Listening on port %s. Press Return to stop.\n' % args.smtp_port)
     except KeyboardInterrupt:
@@ -62,6 +379,10 @@ def main():
     except EOFError:
         pass
     finally:
+        if handler.spool is not None:
+            controller.loop.call_soon_threadsafe(drain.cancel)
+        asyncio.run_coroutine_threadsafe(handler.close(),
+                                         controller.loop).result()
         controller.stop()
 
 